@@ -0,0 +1,181 @@
+""" Backpressure - circuit breakers for the upstream services and an adaptive
+    limit of the messages processed concurrently
+"""
+
+import functools
+import threading
+import time
+
+from config import logger, other_config
+from metrics import metrics
+
+
+class CircuitOpenError(Exception):
+    """ The call was not made, the upstream service is failing
+    """
+
+
+class CircuitBreaker:
+    """ Stops the calls to an upstream service after `failure_threshold`
+        consecutive failures. After `reset_timeout` seconds one call is let
+        through: if it succeeds the calls go on, otherwise the circuit stays
+        open for another `reset_timeout`. A threshold of 0 disables it.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        # when the circuit was opened, None while it is closed
+        self.opened = None
+        self.probing = False
+
+    def reset(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def wait_time(self):
+        """ Seconds before a call can be made, 0 if it can be made now.
+        """
+        with self.lock:
+            if self.opened is None:
+                return 0
+            if self.probing:
+                # the result of the call let through is not known yet
+                return 1
+            return max(self.opened + self.reset_timeout - time.monotonic(), 0)
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.probing or (
+                time.monotonic() - self.opened < self.reset_timeout
+            ):
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            if self.opened is not None:
+                logger.info("CLOSED circuit of %s, it is back", self.name)
+                metrics.inc("%s_circuit_closed" % self.name)
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if not self.failure_threshold:
+                return
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened is None:
+                    logger.warning(
+                        "OPEN circuit of %s after %s failures, retrying in "
+                        "%ss",
+                        self.name,
+                        self.failures,
+                        self.reset_timeout,
+                    )
+                    metrics.inc("%s_circuit_opened" % self.name)
+                self.opened = time.monotonic()
+                self.probing = False
+
+    def call(self, func, *args, ignore=(), **kwargs):
+        """ Call `func` if the circuit is closed, otherwise raise
+            `CircuitOpenError`. The exceptions in `ignore` are errors of
+            the request, not of the service, and do not count as failures.
+        """
+        if not self.allow():
+            metrics.inc("%s_circuit_rejected" % self.name)
+            raise CircuitOpenError(
+                "%s is unavailable, retrying in %.0fs"
+                % (self.name, self.wait_time())
+            )
+        try:
+            result = func(*args, **kwargs)
+        except ignore:
+            self.record_success()
+            raise
+        except Exception as e:
+            self.record_failure()
+            e.upstream_failure = self.name
+            raise
+        self.record_success()
+        return result
+
+    def protect(self, ignore=()):
+        """ Decorator making each call through the circuit breaker.
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return self.call(func, *args, ignore=ignore, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+class AdaptiveLimit:
+    """ Limit of the calls made concurrently, between 1 and `maximum`. It
+        grows by one after `value` calls that succeed within
+        `latency_target` seconds and is halved by a failed or slower call.
+        A `latency_target` of 0 only reacts to the failures.
+    """
+
+    def __init__(self, maximum, latency_target=0):
+        self.maximum = max(maximum, 1)
+        self.latency_target = latency_target
+        self.lock = threading.Lock()
+        self.value = self.maximum
+        # calls that succeeded since the limit last changed
+        self.successes = 0
+
+    def record(self, seconds, ok):
+        with self.lock:
+            if ok and (
+                not self.latency_target or seconds <= self.latency_target
+            ):
+                self.successes += 1
+                if self.successes >= self.value:
+                    self.value = min(self.value + 1, self.maximum)
+                    self.successes = 0
+            else:
+                self.value = max(self.value // 2, 1)
+                self.successes = 0
+
+
+breakers = {
+    name: CircuitBreaker(
+        name, other_config["breaker_failures"], other_config["breaker_reset"]
+    )
+    for name in ["sds", "odp"]
+}
+
+
+def is_upstream_failure(exc):
+    """ True if `exc`, or an exception it was raised from or while handling,
+        is a `CircuitOpenError` or a failure counted by a circuit breaker.
+        The other errors are errors of the message, not of the services.
+    """
+    while exc is not None:
+        if isinstance(exc, CircuitOpenError) or getattr(
+            exc, "upstream_failure", None
+        ):
+            return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def upstream_wait():
+    """ Seconds before all the upstream services can be called
+    """
+    return max(breaker.wait_time() for breaker in breakers.values())
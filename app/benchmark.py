@@ -0,0 +1,333 @@
+""" Benchmark - time the publish pipeline stages over the recorded SDS
+    responses in "tests/sds_responses", with SDS, ODP and RabbitMQ mocked.
+
+Usage::
+
+    python benchmark.py                 # run and compare with the baseline
+    python benchmark.py --save          # run and store a new baseline
+    python benchmark.py -k parse        # only the stages matching "parse"
+    python benchmark.py -k import       # only the start-up of the scripts
+"""
+
+import argparse
+import gc
+import json
+import re
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from unittest import mock
+
+from config import logger
+import ckanclient
+from renderer import DirectRenderer
+
+HERE = Path(__file__).resolve().parent
+SDS_RESPONSES = HERE / "tests" / "sds_responses"
+BASELINE = HERE / "benchmark_baseline.json"
+
+DATASETS = {
+    "DAT-21-en": "european-union-emissions-trading-scheme-13",
+    "DAT-137-en": "eunis-habitat-classification",
+    "DAT-150-en": "air-pollutant-concentrations-at-station",
+    "DAT-176-en": "fuel-quality-directive-1",
+}
+DATASET_PREFIX = "http://www.eea.europa.eu/data-and-maps/data/"
+# the command line entry points, their import time is their start-up cost;
+# it depends on the file system and the installed packages more than on the
+# code, so it is reported but not compared with the baseline
+SCRIPTS = ["ckanclient", "sdsclient", "remap"]
+# a fixed CPU bound stage, measured in every run; the other stages are
+# compared with the baseline relative to it, so the load of the machine
+# does not show up as a regression
+REFERENCE = "reference"
+
+
+def load_rdf(product_id):
+    return (SDS_RESPONSES / (product_id + ".rdf")).read_text("utf-8")
+
+
+def enlarge_rdf(rdf, dataset_url, copies):
+    """ Add `copies` copies of every distribution of the dataset, with new
+        URLs, to simulate datasets with many files.
+    """
+    blocks = re.findall(
+        r"<rdf:Description rdf:about=\"(%s/[^\"]+)\">(.*?)</rdf:Description>"
+        % re.escape(dataset_url),
+        rdf,
+        re.S,
+    )
+    extra = []
+    for n in range(copies):
+        for url, body in blocks:
+            copy_url = "%s-copy-%s" % (url, n)
+            body = body.replace(url, copy_url)
+            extra.append(
+                '<rdf:Description rdf:about="%s">%s</rdf:Description>\n'
+                '<rdf:Description rdf:about="%s">'
+                '<distribution xmlns="http://www.w3.org/ns/dcat#" '
+                'rdf:resource="%s"/></rdf:Description>\n'
+                % (copy_url, body, dataset_url, copy_url)
+            )
+    return rdf.replace("</rdf:RDF>", "".join(extra) + "</rdf:RDF>")
+
+
+def make_client():
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.fingerprints = None
+    cc.odp = mock.Mock()
+    cc.odp.package_show.return_value = None
+    cc.sds.get_latest_version = lambda url: url
+    return cc
+
+
+def measure(func, repeat, rounds):
+    """ Run `func` `repeat` times in each of `rounds` rounds, returns the
+        seconds per call of the median round and the peak memory allocated
+        by one call, in KiB. Memory is traced in a separate call, tracing
+        slows down the timed ones. The garbage collector is disabled while
+        timing, as in `timeit`.
+    """
+    func()
+    times = []
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                func()
+            elapsed = time.perf_counter() - start
+            times.append(elapsed)
+            gc.collect()
+    finally:
+        gc.enable()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(times) / repeat, peak / 1024
+
+
+def reference():
+    """ The reference stage, pure Python work with no I/O
+    """
+    items = [(n * 7919) % 10007 for n in range(20000)]
+    return sorted(str(n) for n in items)
+
+
+def import_time(module):
+    """ Seconds to import `module` in a new interpreter, as reported by
+        `python -X importtime`.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=str(HERE),
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    for line in reversed(proc.stderr.splitlines()):
+        _self, cumulative, name = line.split(":", 1)[1].split("|")
+        if name.strip() == module:
+            return int(cumulative) / 1e6
+    raise RuntimeError("No import time for %r" % module)
+
+
+def stages(repeat):
+    """ Yields (name, function, repeat, items) for every benchmarked stage,
+        where `items` is the number of datasets handled by one call.
+    """
+    yield REFERENCE, reference, repeat, 1
+
+    cc = make_client()
+    direct = make_client()
+    direct.renderer = DirectRenderer()
+    for product_id, name in DATASETS.items():
+        url = DATASET_PREFIX + name
+        rdf = load_rdf(product_id)
+        big_rdf = enlarge_rdf(rdf, url, 20)
+
+        for parser in ["rdflib", "index"]:
+
+            def parse(rdf=rdf, url=url, parser=parser):
+                cc.sds.parser = parser
+                return cc.sds.parse_dataset(rdf, url)
+
+            def parse_big(rdf=big_rdf, url=url, parser=parser):
+                cc.sds.parser = parser
+                return cc.sds.parse_dataset(rdf, url)
+
+            yield (
+                "parse_dataset[%s,%s]" % (parser, product_id),
+                parse,
+                repeat,
+                1,
+            )
+            if big_rdf != rdf:
+                yield (
+                    "parse_dataset[%s,%s-x20]" % (parser, product_id),
+                    parse_big,
+                    max(repeat // 10, 1),
+                    1,
+                )
+
+        cc.sds.parser = "rdflib"
+        data = cc.sds.parse_dataset(rdf, url)
+        data["uri"] = cc.get_ckan_uri(data["product_id"])
+
+        def render(data=data):
+            return cc.render_ckan_rdf(data)
+
+        def render_direct(data=data):
+            return direct.render_ckan_rdf(data)
+
+        def publish(rdf=rdf, url=url):
+            with mock.patch.object(cc.sds, "query_sds", return_value=rdf):
+                cc.publish_dataset(url)
+
+        yield "render_ckan_rdf[%s]" % product_id, render, repeat, 1
+        yield (
+            "render_ckan_rdf[direct,%s]" % product_id,
+            render_direct,
+            repeat,
+            1,
+        )
+        yield "publish_dataset[%s]" % product_id, publish, repeat, 1
+
+    messages = 100
+
+    def consume():
+        rdf = load_rdf("DAT-176-en")
+        bodies = [
+            (
+                mock.Mock(delivery_tag=n),
+                mock.Mock(content_encoding="utf-8"),
+                ("update|%sdataset-%s|_id" % (DATASET_PREFIX, n)).encode(),
+            )
+            for n in range(messages)
+        ]
+        cc.rabbit = mock.Mock()
+        cc.rabbit.get_message.side_effect = lambda queue_name: (
+            bodies.pop(0)
+            if bodies and queue_name == cc.queue_name
+            else (None, None, None)
+        )
+        with mock.patch.object(cc.sds, "query_sds", return_value=rdf):
+            cc.start_consuming_ex()
+
+    yield "message_callback[queue-%s]" % messages, consume, 1, messages
+
+
+def run(pattern, repeat, rounds):
+    """ Run the stages matching `pattern`, and the reference stage, and
+        print, for each, the time per call, the throughput in datasets per
+        second and the peak memory.
+    """
+    results = {}
+    for module in SCRIPTS:
+        name = "import[%s]" % module
+        if pattern and pattern not in name:
+            continue
+        # the fastest of a few runs, the first ones also fill the OS cache
+        seconds = min(import_time(module) for _ in range(5))
+        results[name] = {"seconds": seconds, "peak_kib": 0}
+        print("%-40s %10.2f ms (not compared)" % (name, seconds * 1000))
+
+    for name, func, n, items in stages(repeat):
+        if pattern and pattern not in name and name != REFERENCE:
+            continue
+        seconds, peak = measure(func, n, rounds)
+        results[name] = {"seconds": seconds, "peak_kib": peak}
+        print(
+            "%-40s %10.2f ms %8.1f datasets/s %8.0f KiB"
+            % (name, seconds * 1000, items / seconds, peak)
+        )
+    return results
+
+
+def compare(results, baseline, tolerance, min_delta=0.001):
+    """ Returns the names of the stages slower than the baseline by more
+        than `tolerance` (a fraction) and by more than `min_delta` seconds.
+        The baseline is first scaled by the speed of the reference stage in
+        this run against its speed in the baseline, when it is slower: the
+        reference is noisy too, a fast run of it would make every other
+        stage look slower. The import times are not compared.
+    """
+    scale = 1
+    if REFERENCE in results and REFERENCE in baseline:
+        scale = max(
+            results[REFERENCE]["seconds"] / baseline[REFERENCE]["seconds"], 1
+        )
+    regressions = []
+    for name, result in results.items():
+        if (
+            name not in baseline
+            or name == REFERENCE
+            or name.startswith("import[")
+        ):
+            continue
+        before = baseline[name]["seconds"] * scale
+        seconds = result["seconds"]
+        if seconds > before * (1 + tolerance) and (
+            seconds - before > min_delta
+        ):
+            regressions.append(name)
+            print(
+                "REGRESSION %s: %.2f ms, baseline %.2f ms"
+                % (name, seconds * 1000, before * 1000)
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark")
+    parser.add_argument(
+        "-k", dest="pattern", help="only run the stages matching PATTERN"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=10, help="iterations per round"
+    )
+    parser.add_argument(
+        "--rounds",
+        type=int,
+        default=5,
+        help="rounds per stage, the median one is kept",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.5,
+        help="allowed slowdown against the baseline, as a fraction",
+    )
+    parser.add_argument(
+        "--min-delta",
+        type=float,
+        default=1.0,
+        help="slowdowns smaller than MIN_DELTA ms are not regressions",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="store the results as baseline"
+    )
+    args = parser.parse_args()
+
+    logger.setLevel("WARNING")
+    results = run(args.pattern, args.repeat, args.rounds)
+
+    if args.save:
+        baseline = {}
+        if BASELINE.exists():
+            baseline = json.loads(BASELINE.read_text("utf-8"))
+        baseline.update(results)
+        BASELINE.write_text(
+            json.dumps(baseline, indent=2, sort_keys=True) + "\n", "utf-8"
+        )
+
+    elif BASELINE.exists():
+        baseline = json.loads(BASELINE.read_text("utf-8"))
+        if compare(
+            results, baseline, args.tolerance, args.min_delta / 1000
+        ):
+            sys.exit(1)
@@ -2,97 +2,697 @@
 """
 
 import argparse
+import functools
+import hashlib
+import json
+import signal
+import threading
+import time
 import uuid
-from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import jinja2
+import pika
+import pika.exceptions
 from eea.rabbitmq.client import RabbitMQConnector
 
+from backpressure import (
+    AdaptiveLimit,
+    CircuitOpenError,
+    is_upstream_failure,
+    upstream_wait,
+)
 from config import logger, rabbit_config, services_config, other_config
-from sdsclient import SDSClient
-from odpclient import ODPClient
+from sdsclient import SDSClient, bulk_queue_name
+from metrics import metrics
+from store import ConceptStore, FingerprintStore
 
 
-jinja_env = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(
-        searchpath=str(Path(__file__).parent / "templates"),
-    ),
-    autoescape=jinja2.select_autoescape(["html", "xml"]),
-)
+def retry_queue_name(queue_name):
+    """ The queue where the failed messages of `queue_name` wait before
+        they go back to it
+    """
+    return queue_name + "_retry"
+
+
+def failed_queue_name(queue_name):
+    """ The queue where the messages of `queue_name` that failed more than
+        `max_retries` times are parked, until they are moved back by hand
+    """
+    return queue_name + "_failed"
+
+
+class AckBatcher:
+    """ Acknowledges the messages of a channel in batches of `size`. The
+        processed messages delivered before any unprocessed one are
+        acknowledged together with `multiple=True`, the others one by one.
+        A message that is not acknowledged, e.g. a requeued one, must be
+        `discard`ed when it is rejected, it would hold back the others.
+    """
+
+    def __init__(self, channel, size):
+        self.channel = channel
+        self.size = max(size, 1)
+        # delivery tags not acknowledged nor rejected yet, in delivery order
+        self.delivered = []
+        self.processed = set()
+
+    def add(self, delivery_tag):
+        self.delivered.append(delivery_tag)
+
+    def ack(self, delivery_tag):
+        self.processed.add(delivery_tag)
+        if len(self.processed) >= self.size:
+            self.flush()
+
+    def discard(self, delivery_tag):
+        self.delivered.remove(delivery_tag)
+
+    def flush(self):
+        count = 0
+        while self.delivered and self.delivered[0] in self.processed:
+            last = self.delivered.pop(0)
+            self.processed.remove(last)
+            count += 1
+        if count == 1:
+            self.channel.basic_ack(delivery_tag=last)
+        elif count > 1:
+            self.channel.basic_ack(delivery_tag=last, multiple=True)
+        for delivery_tag in sorted(self.processed):
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+            self.delivered.remove(delivery_tag)
+        self.processed.clear()
 
 
 class CKANClient:
     """ CKAN Client
     """
 
-    def __init__(self, queue_name):
+    # seconds to wait before connecting again to RabbitMQ in daemon mode
+    reconnect_delay = 10
+    # seconds to wait before loading the concepts again after a failure
+    refresh_retry = 60
+
+    def __init__(
+        self,
+        queue_name,
+        workers=None,
+        prefetch=None,
+        force=False,
+        deterministic_uuids=None,
+    ):
         """ """
         self.queue_name = queue_name
+        self.force = force
+        if deterministic_uuids is None:
+            deterministic_uuids = other_config["deterministic_uuids"]
+        self.deterministic_uuids = deterministic_uuids
+        self.retry_delay = other_config["retry_delay"]
+        self.max_retries = other_config["max_retries"]
+        self.ack_batch = other_config["ack_batch"]
+        self.stopping = False
+        self.workers = max(workers or other_config["workers"], 1)
+        self.prefetch = max(
+            prefetch or other_config["prefetch"] or 2 * self.workers,
+            self.workers,
+        )
+        # messages processed concurrently, lowered when the upstream
+        # services fail or slow down
+        self.limiter = AdaptiveLimit(
+            self.workers, other_config["latency_target"]
+        )
+        self.max_pause = other_config["max_pause"]
         self.rabbit = RabbitMQConnector(**rabbit_config)
-        self.odp = ODPClient()
-        self.sds = SDSClient(
-            services_config["sds"],
-            other_config["timeout"],
-            queue_name,
-            self.odp,
+        # the ODP and SDS clients and the renderer are created on first use,
+        # nothing is loaded for them when the queue is empty
+        self._odp = None
+        self._sds = None
+        self._renderer = None
+        self.lazy_lock = threading.Lock()
+        # queues in the order they are consumed, the messages sent by the
+        # CMS go before the ones sent by the bulk updates
+        self.queue_names = [queue_name, bulk_queue_name(queue_name)]
+        self.fingerprints = None
+        if other_config["state_db"]:
+            self.fingerprints = FingerprintStore(other_config["state_db"])
+        self.concepts_ttl = other_config["concepts_ttl"]
+        self.concepts = None
+        if self.concepts_ttl:
+            self.concepts = ConceptStore(
+                other_config["state_db"] or ":memory:"
+            )
+        self.concepts_refreshed = None
+        self.concepts_lock = threading.Lock()
+        self.concepts_refreshing = False
+        # the concepts are not loaded before this time, after a failure
+        self.concepts_retry = 0
+
+    @property
+    def odp(self):
+        with self.lazy_lock:
+            if self._odp is None:
+                from odpclient import ODPClient
+
+                self._odp = ODPClient()
+            return self._odp
+
+    @odp.setter
+    def odp(self, value):
+        self._odp = value
+
+    @property
+    def sds(self):
+        odp = self.odp
+        with self.lazy_lock:
+            if self._sds is None:
+                self._sds = SDSClient(
+                    services_config["sds"],
+                    other_config["timeout"],
+                    self.queue_name,
+                    odp,
+                )
+            return self._sds
+
+    @sds.setter
+    def sds(self, value):
+        self._sds = value
+
+    @property
+    def renderer(self):
+        with self.lazy_lock:
+            if self._renderer is None:
+                from renderer import make_renderer
+
+                self._renderer = make_renderer(
+                    other_config["renderer"], other_config["jinja_cache_dir"]
+                )
+            return self._renderer
+
+    @renderer.setter
+    def renderer(self, value):
+        self._renderer = value
+
+    def get_message(self):
+        """ Get a message from the first of `queue_names` that is not
+            empty. Returns `(queue_name, method, properties, body)`, all
+            None if all the queues are empty.
+        """
+        for queue_name in self.queue_names:
+            method, properties, body = self.rabbit.get_message(queue_name)
+            if method is not None:
+                return queue_name, method, properties, body
+        return None, None, None, None
+
+    def declare_queues(self, channel):
+        """ Declare the queues and their retry and failed queues (see
+            `retry_later`)
+        """
+        for queue_name in self.queue_names:
+            self.rabbit.declare_queue(queue_name)
+            # the messages expire after `retry_delay`, set on each message
+            # so it can be changed without declaring the queue again
+            channel.queue_declare(
+                queue=retry_queue_name(queue_name),
+                durable=True,
+                arguments={
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": queue_name,
+                },
+            )
+            channel.queue_declare(
+                queue=failed_queue_name(queue_name), durable=True
+            )
+
+    def retry_later(self, channel, queue_name, properties, body, retries=1):
+        """ Publish a failed message to the retry queue of `queue_name`,
+            from where it goes back to the end of `queue_name` after
+            `self.retry_delay` seconds. Its "retries" header is increased
+            by `retries`; past `self.max_retries` (if set) the message goes
+            to the failed queue instead, and stays there. The caller
+            acknowledges the original message.
+        """
+        headers = dict(properties.headers or {})
+        headers["retries"] = headers.get("retries", 0) + retries
+        routing_key = retry_queue_name(queue_name)
+        expiration = str(self.retry_delay * 1000)
+        if self.max_retries and headers["retries"] > self.max_retries:
+            logger.error(
+                "PARKED message '%s' in '%s' after %s retries",
+                body,
+                failed_queue_name(queue_name),
+                self.max_retries,
+            )
+            metrics.inc("messages_parked")
+            routing_key = failed_queue_name(queue_name)
+            expiration = None
+        channel.basic_publish(
+            exchange="",
+            routing_key=routing_key,
+            body=body,
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+                content_encoding=properties.content_encoding,
+                headers=headers,
+                expiration=expiration,
+            ),
         )
 
+    def in_flight_limit(self):
+        """ How many messages can be fetched and not processed yet:
+            `self.prefetch` at full speed, the adaptive limit when it is
+            below `self.workers`.
+        """
+        limit = self.limiter.value
+        return self.prefetch if limit >= self.workers else limit
+
+    def normalize_url(self, dataset_url):
+        """ The form of a dataset URL used in SDS: http, no trailing slash
+        """
+        dataset_url = dataset_url.strip().rstrip("/")
+        if dataset_url.startswith("https://"):
+            dataset_url = "http://" + dataset_url[len("https://"):]
+        return dataset_url
+
+    def prepare(self):
+        """ Load the version index, and refresh it if it is stale, before
+            connecting to RabbitMQ: `get_target` runs in the thread that
+            talks to RabbitMQ, and must not wait for SDS there.
+        """
+        if other_config["version_index_ttl"]:
+            try:
+                self.sds.get_version_index(wait=True)
+            except Exception:
+                logger.exception("Could not load the version index")
+
+    def get_target(self, body):
+        """ What processing the message publishes: the latest version of its
+            dataset if the version index is enabled, otherwise its normalized
+            URL. Messages with the same target are processed once. Messages
+            that are not published are their own target.
+        """
+        try:
+            action, dataset_url, _dataset_identifier = body.split("|")
+        except ValueError:
+            return body
+        if action not in ["update", "create"]:
+            return body
+        dataset_url = self.normalize_url(dataset_url)
+        if self.sds.version_index_ttl:
+            try:
+                return self.sds.get_latest_version(dataset_url)
+            except Exception:
+                logger.exception("Could not resolve '%s'", dataset_url)
+        return dataset_url
+
     def start_consuming_ex(self):
         """ It will consume all the messages from the queue and stops after.
+
+            Messages are processed by a pool of `self.workers` threads, with
+            at most `self.prefetch` messages fetched and not yet acknowledged
+            at any time. All the RabbitMQ calls are made from this thread,
+            the workers only run `message_callback`.
+
+            Messages with the same target (see `get_target`) are coalesced:
+            the first one is processed and the others are acknowledged with
+            it. Acknowledgements are sent in batches of `self.ack_batch`.
+
+            A message that fails is moved to the retry queue and
+            acknowledged (see `retry_later`), so it does not hold back the
+            acknowledgements of the others; the messages of a target that
+            failed are not processed again in the same run.
+
+            Fewer messages are fetched while the upstream services fail or
+            slow down (see `in_flight_limit`), and none while a circuit
+            breaker is open. The messages that fail while a circuit is open
+            are requeued. The run stops if nothing could be processed for
+            `self.max_pause` seconds.
         """
-        logger.info("START consuming from '%s'", self.queue_name)
+        logger.info(
+            "START consuming from '%s' with %s worker(s)",
+            self.queue_name,
+            self.workers,
+        )
+        if other_config["metrics_port"]:
+            metrics.serve(other_config["metrics_port"])
+        self.prepare()
         self.rabbit.open_connection()
-        self.rabbit.declare_queue(self.queue_name)
+        channel = self.rabbit.get_channel()
+        self.declare_queues(channel)
         processed_messages = {}
+        failed_messages = {}
+        # target -> delivery tags of the messages waiting for it to be
+        # processed
+        in_progress = {}
+        # delivery tag -> (queue name, properties, body) of the messages
+        # not acknowledged yet
+        deliveries = {}
+        pending = {}
+        acks = AckBatcher(channel, self.ack_batch)
+        queue_empty = False
+        # since when no message could be processed, while paused
+        paused = None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                while (
+                    not queue_empty
+                    and len(pending) < self.in_flight_limit()
+                    and not upstream_wait()
+                ):
+                    queue_name, method, properties, body = self.get_message()
+                    if method is None:
+                        logger.info("Queue is empty '%s'.", self.queue_name)
+                        queue_empty = True
+                        break
+                    body_txt = body.decode(
+                        properties.content_encoding or "ascii"
+                    )
+                    target = self.get_target(body_txt)
+                    acks.add(method.delivery_tag)
+                    if target in processed_messages:
+                        # duplicate message, acknowledge to skip
+                        acks.ack(method.delivery_tag)
+                        metrics.inc("messages_duplicate")
+                        logger.info(
+                            "DUPLICATE skipping message '%s' in '%s'",
+                            body_txt,
+                            self.queue_name,
+                        )
+                    elif target in failed_messages:
+                        # back from the retry queue, or a duplicate: wait for
+                        # the next run
+                        self.retry_later(
+                            channel, queue_name, properties, body, retries=0
+                        )
+                        acks.ack(method.delivery_tag)
+                        logger.info(
+                            "FAILED before, retrying later '%s' in '%s'",
+                            body_txt,
+                            self.queue_name,
+                        )
+                    elif target in in_progress:
+                        # duplicate of a message being processed, its outcome
+                        # decides if this one is acknowledged too
+                        in_progress[target].append(method.delivery_tag)
+                        deliveries[method.delivery_tag] = (
+                            queue_name,
+                            properties,
+                            body,
+                        )
+                    else:
+                        in_progress[target] = [method.delivery_tag]
+                        deliveries[method.delivery_tag] = (
+                            queue_name,
+                            properties,
+                            body,
+                        )
+                        future = executor.submit(
+                            self.message_callback, body_txt
+                        )
+                        pending[future] = target
+
+                if not pending:
+                    if queue_empty:
+                        break
+                    # an upstream service is unavailable
+                    wait_time = upstream_wait()
+                    if not wait_time:
+                        continue
+                    now = time.monotonic()
+                    if paused is None:
+                        paused = now
+                    if now + wait_time - paused > self.max_pause:
+                        logger.error(
+                            "STOP consuming from '%s', the upstream services "
+                            "are unavailable for %.0fs",
+                            self.queue_name,
+                            now - paused,
+                        )
+                        break
+                    logger.warning(
+                        "PAUSE consuming from '%s' for %.0fs",
+                        self.queue_name,
+                        wait_time,
+                    )
+                    time.sleep(wait_time)
+                    continue
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    target = pending.pop(future)
+                    delivery_tags = in_progress.pop(target)
+                    try:
+                        ok = future.result()
+                    except CircuitOpenError:
+                        # not processed, get it again once the circuit closes
+                        for delivery_tag in delivery_tags:
+                            deliveries.pop(delivery_tag)
+                            acks.discard(delivery_tag)
+                            channel.basic_nack(
+                                delivery_tag=delivery_tag, requeue=True
+                            )
+                        # the queue is not empty anymore
+                        queue_empty = False
+                        continue
+                    if not ok:
+                        failed_messages[target] = 1
+                        for delivery_tag in delivery_tags:
+                            self.retry_later(
+                                channel, *deliveries.pop(delivery_tag)
+                            )
+                            acks.ack(delivery_tag)
+                        continue
+                    paused = None
+                    processed_messages[target] = 1
+                    for delivery_tag in delivery_tags:
+                        deliveries.pop(delivery_tag)
+                        acks.ack(delivery_tag)
+                    if len(delivery_tags) > 1:
+                        metrics.inc(
+                            "messages_duplicate", len(delivery_tags) - 1
+                        )
+                        logger.info(
+                            "DUPLICATE skipping %s x '%s' in '%s'",
+                            len(delivery_tags) - 1,
+                            target,
+                            self.queue_name,
+                        )
+
+        acks.flush()
+        self.rabbit.close_connection()
+        logger.info("DONE consuming from '%s'", self.queue_name)
+        metrics.log_summary()
+        if other_config["metrics_file"]:
+            metrics.write(other_config["metrics_file"])
+
+    def stop(self, signum=None, frame=None):
+        """ Stop the daemon after the messages in progress are processed.
+        """
+        logger.info("STOP requested, finishing the messages in progress")
+        self.stopping = True
+
+    def start_consuming_daemon(self):
+        """ Keep consuming the messages as they are delivered, until SIGTERM
+            or SIGINT. The connections to RabbitMQ, SDS and ODP are kept
+            open between messages; RabbitMQ is reconnected if it fails.
+        """
+        logger.info(
+            "START daemon consuming from '%s' with %s worker(s)",
+            self.queue_name,
+            self.workers,
+        )
+        self.stopping = False
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if other_config["metrics_port"]:
+            metrics.serve(other_config["metrics_port"])
+        self.prepare()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self.stopping:
+                try:
+                    self.consume_deliveries(executor)
+                except (pika.exceptions.AMQPError, ConnectionError):
+                    logger.exception(
+                        "RabbitMQ connection failed, reconnecting in %ss",
+                        self.reconnect_delay,
+                    )
+                    time.sleep(self.reconnect_delay)
+
+        logger.info("DONE daemon consuming from '%s'", self.queue_name)
+        metrics.log_summary()
+        if other_config["metrics_file"]:
+            metrics.write(other_config["metrics_file"])
+
+    def consume_deliveries(self, executor):
+        """ Consume the messages pushed by RabbitMQ on one connection, until
+            `self.stopping` is set. At most `self.prefetch` messages are
+            delivered and not yet acknowledged. A message that fails is
+            acknowledged and published to the retry queue of its queue (see
+            `retry_queue_name`), with its number of retries in the
+            "retries" header; after `self.retry_delay` seconds it goes back
+            to the end of its queue. After `self.max_retries` retries it is
+            moved to the failed queue. Failing messages never hold the
+            prefetch window.
+            The lower priority queues are only read when fewer messages than
+            `self.workers` are in progress, so a new message in the first
+            queue never waits behind more than one round of them. That limit
+            is lowered while the upstream services fail or slow down.
+            While a circuit breaker is open, the messages are not processed
+            but requeued when the service can be tried again.
+            Acknowledgements are sent in batches of `self.ack_batch`, and at
+            least once a second.
+        """
+        self.rabbit.open_connection()
         channel = self.rabbit.get_channel()
-        while True:
-            method, properties, body = self.rabbit.get_message(self.queue_name)
-            if method is None and properties is None and body is None:
-                logger.info("Queue is empty '%s'.", self.queue_name)
-                break
-            body_txt = body.decode(properties.content_encoding or "ascii")
-            if body_txt not in processed_messages:
-                ok = self.message_callback(body_txt)
-                if ok:
-                    processed_messages[body_txt] = 1
-                    channel.basic_ack(delivery_tag=method.delivery_tag)
+        if channel is None:
+            raise ConnectionError("Could not connect to RabbitMQ")
+        connection = channel.connection
+        self.declare_queues(channel)
+        channel.basic_qos(prefetch_count=self.prefetch)
+        acks = AckBatcher(channel, self.ack_batch)
+        # target -> delivery tags of the messages waiting for it to be
+        # processed
+        in_progress = {}
+        # delivery tag -> (queue name, properties, body) of the messages
+        # not acknowledged yet
+        deliveries = {}
+
+        def requeue(delivery_tag):
+            deliveries.pop(delivery_tag)
+            acks.discard(delivery_tag)
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+        def retry(delivery_tag):
+            self.retry_later(channel, *deliveries.pop(delivery_tag))
+            acks.ack(delivery_tag)
+
+        def defer(delivery_tag):
+            connection.add_timeout(
+                max(upstream_wait(), 1),
+                functools.partial(requeue, delivery_tag),
+            )
+
+        def on_processed(target, future):
+            delivery_tags = in_progress.pop(target)
+            try:
+                ok = future.result()
+            except CircuitOpenError:
+                for delivery_tag in delivery_tags:
+                    defer(delivery_tag)
+                return
+            if ok:
+                for delivery_tag in delivery_tags:
+                    deliveries.pop(delivery_tag)
+                    acks.ack(delivery_tag)
+                if len(delivery_tags) > 1:
+                    metrics.inc("messages_duplicate", len(delivery_tags) - 1)
             else:
-                # duplicate message, acknowledge to skip
-                self.rabbit.get_channel().basic_ack(
-                    delivery_tag=method.delivery_tag
-                )
-                logger.info(
-                    "DUPLICATE skipping message '%s' in '%s'",
-                    body_txt,
-                    self.queue_name,
+                for delivery_tag in delivery_tags:
+                    retry(delivery_tag)
+
+        def on_done(target, future):
+            # called in a worker thread, hand over to the connection thread
+            try:
+                connection.add_callback_threadsafe(
+                    functools.partial(on_processed, target, future)
                 )
+            except Exception:
+                logger.exception("Could not acknowledge '%s'", target)
+
+        def on_message(
+            channel, method, properties, body, queue_name=self.queue_name
+        ):
+            acks.add(method.delivery_tag)
+            deliveries[method.delivery_tag] = (queue_name, properties, body)
+            if upstream_wait():
+                metrics.inc("messages_deferred")
+                defer(method.delivery_tag)
+                return
+            body_txt = body.decode(properties.content_encoding or "ascii")
+            target = self.get_target(body_txt)
+            if target in in_progress:
+                in_progress[target].append(method.delivery_tag)
+                return
+            in_progress[target] = [method.delivery_tag]
+            future = executor.submit(self.message_callback, body_txt)
+            future.add_done_callback(functools.partial(on_done, target))
+
+        consumer_tag = channel.basic_consume(on_message, queue=self.queue_name)
+        while not self.stopping:
+            connection.process_data_events(time_limit=1)
+            for queue_name in self.queue_names[1:]:
+                while (
+                    len(in_progress) < self.limiter.value
+                    and not upstream_wait()
+                    and not self.stopping
+                ):
+                    method, properties, body = channel.basic_get(
+                        queue=queue_name, no_ack=False
+                    )
+                    if method is None:
+                        break
+                    on_message(channel, method, properties, body, queue_name)
+            acks.flush()
+
+        channel.basic_cancel(consumer_tag)
+        while in_progress:
+            connection.process_data_events(time_limit=1)
+        acks.flush()
         self.rabbit.close_connection()
-        logger.info("DONE consuming from '%s'", self.queue_name)
 
     def message_callback(self, body):
         """ Callback method for processing a message from the queue.
             If the message is processed ok then acknowledge,
-            otherwise don't - the message will be processed again
-            at the next run.
+            otherwise it is moved to the retry queue, to be processed
+            again later.
             Returns True if the messages was processed ok, otherwise False.
+            Raises `CircuitOpenError` if it failed while a circuit breaker
+            is open: an upstream service is unavailable.
+            The duration and the upstream failures adjust `self.limiter`,
+            the errors of the message itself do not.
         """
         logger.info(
             "START processing message '%s' in '%s'", body, self.queue_name
         )
+        start = time.perf_counter()
         try:
             action, dataset_url, _dataset_identifier = body.split("|")
             if action in ["update", "create"]:
-                self.publish_dataset(dataset_url)
+                # the dataset was just edited, the cached SDS responses
+                # may be stale
+                with self.sds.revalidate():
+                    if not self.publish_dataset(dataset_url):
+                        metrics.inc("messages_skipped")
 
             else:
                 logger.warning("Unsupported action %r, ignoring", action)
 
-        except Exception:
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.limiter.record(time.perf_counter() - start, False)
+            rejected = isinstance(e, CircuitOpenError)
+            if rejected or upstream_wait():
+                # an upstream service is unavailable, retry once it is back
+                logger.warning(
+                    "DEFERRED message '%s' in '%s': %s",
+                    body,
+                    self.queue_name,
+                    e,
+                    exc_info=not rejected,
+                )
+                metrics.inc("messages_deferred")
+                if rejected:
+                    raise
+                raise CircuitOpenError(str(e)) from e
             logger.exception(
                 "ERROR processing message '%s' in '%s'", body, self.queue_name
             )
+            metrics.inc("messages_failed")
             return False
 
+        metrics.inc("messages_processed")
+        self.limiter.record(time.perf_counter() - start, True)
+
         logger.info(
             "DONE processing message '%s' in '%s'", body, self.queue_name
         )
@@ -101,39 +701,137 @@ class CKANClient:
     def get_ckan_uri(self, product_id):
         return "http://data.europa.eu/88u/dataset/" + product_id
 
+    def get_package_concepts(self, package):
+        return [i["uri"] for i in package["dataset"]["subject_dcterms"]]
+
+    def refresh_concepts(self):
+        """ Load the concepts of all the EEA packages in ODP into
+            `self.concepts`, if they were loaded more than `concepts_ttl`
+            seconds ago. One thread searches ODP, the others keep reading
+            the concepts already stored meanwhile. After a failure they are
+            not loaded again for `refresh_retry` seconds.
+        """
+        with self.concepts_lock:
+            now = time.time()
+            if self.concepts_refreshed is None:
+                self.concepts_refreshed = self.concepts.refreshed()
+            if (
+                self.concepts_refreshing
+                or now < self.concepts_retry
+                or (
+                    self.concepts_refreshed is not None
+                    and now - self.concepts_refreshed <= self.concepts_ttl
+                )
+            ):
+                return
+            self.concepts_refreshing = True
+        try:
+            logger.info("Loading the eurovoc concepts of the ODP packages")
+            mapping = {}
+            for package in self.odp.package_search(fq="organization:eea"):
+                uri = package["dataset"]["uri"]
+                product_id = uri[len(self.get_ckan_uri("")):]
+                mapping[product_id] = self.get_package_concepts(package)
+            self.concepts.save(mapping)
+        except Exception:
+            logger.exception(
+                "Could not load the eurovoc concepts, retrying in %ss",
+                self.refresh_retry,
+            )
+            with self.concepts_lock:
+                self.concepts_retry = time.time() + self.refresh_retry
+                self.concepts_refreshing = False
+            return
+        with self.concepts_lock:
+            self.concepts_refreshed = now
+            self.concepts_refreshing = False
+
     def get_odp_eurovoc_concepts(self, product_id):
+        """ The eurovoc concepts of the package in ODP. With `concepts_ttl`
+            set, they are read from `self.concepts`; ODP is only asked for
+            the packages missing there.
+        """
+        if self.concepts is not None:
+            self.refresh_concepts()
+            concepts = self.concepts.get(product_id)
+            if concepts is not None:
+                return concepts
         package = self.odp.package_show(product_id)
-        if package is None:
-            return []
-        return [i["uri"] for i in package["dataset"]["subject_dcterms"]]
+        concepts = []
+        if package is not None:
+            concepts = self.get_package_concepts(package)
+        if self.concepts is not None:
+            self.concepts.set(product_id, concepts)
+        return concepts
+
+    def get_fingerprint(self, data):
+        """ Canonical hash of the dataset data that is rendered for ODP.
+            Lists are hashed regardless of their order, SDS does not return
+            the values in a stable order.
+        """
 
+        def canonical(value):
+            if isinstance(value, dict):
+                return {k: canonical(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return sorted(
+                    (canonical(v) for v in value),
+                    key=lambda v: json.dumps(v, sort_keys=True),
+                )
+            return value
+
+        dump = json.dumps(
+            canonical(data), sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(dump.encode("utf-8")).hexdigest()
+
+    def make_uuid(self, data, *names):
+        """ Identifier of a node in the ODP RDF. Random by default; with
+            `deterministic_uuids` it is derived from the dataset URI and
+            `names`, so the same dataset always renders the same RDF.
+        """
+        if not self.deterministic_uuids:
+            return str(uuid.uuid4())
+        name = "#".join((data["uri"],) + names)
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, name))
+
+    @metrics.timed("render_ckan_rdf")
     def render_ckan_rdf(self, data):
-        """ Render a RDF/XML that the ODP API will accept
+        """ Render a RDF/XML that the ODP API will accept. `data` is not
+            modified, the identifiers are added to a copy.
         """
-        template = jinja_env.get_template("ckan_package.rdf.xml")
+        seen = {}
+        resources = []
         for resource in data.get("resources", []):
-            resource["_uuid"] = str(uuid.uuid4())
-        data.update(
-            {
-                "uuids": {
-                    "landing_page": str(uuid.uuid4()),
-                    "contact": str(uuid.uuid4()),
-                    "contact_homepage": str(uuid.uuid4()),
-                    "contact_telephone": str(uuid.uuid4()),
-                    "contact_address": str(uuid.uuid4()),
-                }
-            }
+            # two distributions can share the same URL
+            n = seen[resource["url"]] = seen.get(resource["url"], 0) + 1
+            uuid_ = self.make_uuid(
+                data, "distribution", resource["url"], str(n)
+            )
+            resources.append(dict(resource, _uuid=uuid_))
+        uuids = {
+            name: self.make_uuid(data, name)
+            for name in [
+                "landing_page",
+                "contact",
+                "contact_homepage",
+                "contact_telephone",
+                "contact_address",
+            ]
+        }
+        return self.renderer.render(
+            dict(data, resources=resources, uuids=uuids)
         )
-        return template.render(data)
 
     def publish_dataset(self, dataset_url):
-        """ Publish dataset to ODP
+        """ Publish dataset to ODP.
+            The upload is skipped if the dataset did not change since it was
+            last published, unless `self.force` is set.
+            Returns True if the dataset was uploaded.
         """
         logger.info("publish dataset '%s'", dataset_url)
 
-        if dataset_url.startswith("https"):
-            dataset_url = dataset_url.replace("https", "http", 1)
-
+        dataset_url = self.normalize_url(dataset_url)
         latest_dataset_url = self.sds.get_latest_version(dataset_url)
         data = self.sds.get_dataset(latest_dataset_url)
         product_id = data["product_id"]
@@ -144,9 +842,24 @@ class CKANClient:
         concepts.update(set(self.get_odp_eurovoc_concepts(product_id)))
         data["concepts_eurovoc"] = sorted(concepts)
 
+        fingerprint = None
+        if self.fingerprints is not None:
+            fingerprint = self.get_fingerprint(data)
+            if not self.force and (
+                self.fingerprints.get(product_id) == fingerprint
+            ):
+                logger.info("UNCHANGED skipping dataset %r", ckan_uri)
+                return False
+
         ckan_rdf = self.render_ckan_rdf(data)
         self.odp.package_save(ckan_uri, ckan_rdf)
 
+        if fingerprint is not None:
+            self.fingerprints.set(product_id, fingerprint)
+        if self.concepts is not None:
+            self.concepts.set(product_id, data["concepts_eurovoc"])
+        return True
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="CKANClient")
@@ -157,9 +870,35 @@ if __name__ == "__main__":
         help="create debug file for dataset data from SDS and the builded "
         "package for ODP",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help="number of messages processed concurrently "
+        "(default: CKAN_CLIENT_WORKERS or 1)",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep consuming the messages as they arrive, until stopped",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always query SDS, even if SDS_CACHE is configured",
+    )
+    parser.add_argument(
+        "--force",
+        "-f",
+        action="store_true",
+        help="upload datasets to ODP even if they did not change since "
+        "they were last published",
+    )
     args = parser.parse_args()
 
-    cc = CKANClient("odp_queue")
+    cc = CKANClient("odp_queue", workers=args.workers, force=args.force)
+    if args.no_cache:
+        cc.sds.cache = None
 
     if args.debug:
         _prefix = "http://www.eea.europa.eu/data-and-maps/data/"
@@ -181,6 +920,9 @@ if __name__ == "__main__":
         for dataset_url in urls:
             cc.publish_dataset(dataset_url)
 
+    elif args.daemon:
+        cc.start_consuming_daemon()
+
     else:
         # read and process all messages from specified queue
         cc.start_consuming_ex()
@@ -25,6 +25,8 @@ ckan_config = {
     'ckan_address': os.environ.get('CKAN_ADDRESS'),
     'ckan_apikey': os.environ.get('CKAN_APIKEY'),
     'ckan_proxy': os.environ.get('CKAN_PROXY'),
+    'ckan_search_rows': int(os.environ.get('CKAN_SEARCH_ROWS') or 100),
+    'ckan_search_workers': int(os.environ.get('CKAN_SEARCH_WORKERS') or 4),
 }
 
 services_config = {
@@ -32,17 +34,43 @@ services_config = {
 }
 
 
-def load_sparql(fname):
-    return open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config', fname), 'r').read()
-
-
 other_config = {
     'timeout': int(os.environ.get('SDS_TIMEOUT') or 60),
-    'query_all_datasets': load_sparql('query_all_datasets.sparql'),
-    'query_dataset': load_sparql('query_dataset.sparql'),
-    'query_replaces': load_sparql('query_replaces.sparql'),
-    'query_latest_version': load_sparql('query_latest_version.sparql'),
+    'connect_timeout': int(os.environ.get('SDS_CONNECT_TIMEOUT') or 10),
+    'pool_size': int(os.environ.get('SDS_POOL_SIZE') or 10),
+    'retries': int(os.environ.get('SDS_RETRIES') or 3),
+    'backoff': float(os.environ.get('SDS_BACKOFF') or 0.5),
+    'sds_cache': os.environ.get('SDS_CACHE'),
+    'sds_cache_ttl': int(os.environ.get('SDS_CACHE_TTL') or 3600),
+    'sds_cache_size': int(os.environ.get('SDS_CACHE_SIZE') or 256),
+    'batch_size': int(os.environ.get('SDS_BATCH_SIZE') or 25),
+    'page_size': int(os.environ.get('SDS_PAGE_SIZE') or 1000),
+    'watermark_overlap': int(
+        os.environ.get('SDS_WATERMARK_OVERLAP') or 86400
+    ),
+    'publish_batch': int(os.environ.get('RABBITMQ_PUBLISH_BATCH') or 0),
+    'parser': os.environ.get('SDS_PARSER') or 'rdflib',
+    'version_index_ttl': int(os.environ.get('SDS_VERSION_INDEX_TTL') or 0),
     'old_datasets_repo': os.environ.get('OLD_DATASETS_REPO'),
+    'remap_workers': int(os.environ.get('REMAP_WORKERS') or 8),
+    'state_db': os.environ.get('STATE_DB'),
+    'deterministic_uuids': bool(os.environ.get('DETERMINISTIC_UUIDS')),
+    'renderer': os.environ.get('CKAN_CLIENT_RENDERER') or 'template',
+    'jinja_cache_dir': os.environ.get('JINJA_CACHE_DIR'),
+    'metrics_file': os.environ.get('METRICS_FILE'),
+    'metrics_port': int(os.environ.get('METRICS_PORT') or 0),
+    'workers': int(os.environ.get('CKAN_CLIENT_WORKERS') or 1),
+    'prefetch': int(os.environ.get('CKAN_CLIENT_PREFETCH') or 0),
+    'retry_delay': int(os.environ.get('CKAN_CLIENT_RETRY_DELAY') or 300),
+    'max_retries': int(os.environ.get('CKAN_CLIENT_MAX_RETRIES') or 12),
+    'concepts_ttl': int(os.environ.get('ODP_CONCEPTS_TTL') or 0),
+    'ack_batch': int(os.environ.get('RABBITMQ_ACK_BATCH') or 1),
+    'breaker_failures': int(os.environ.get('CIRCUIT_BREAKER_FAILURES') or 5),
+    'breaker_reset': int(os.environ.get('CIRCUIT_BREAKER_RESET') or 30),
+    'latency_target': float(
+        os.environ.get('CKAN_CLIENT_LATENCY_TARGET') or 30
+    ),
+    'max_pause': int(os.environ.get('CKAN_CLIENT_MAX_PAUSE') or 900),
 }
 
 
@@ -0,0 +1,162 @@
+""" Metrics - message counters and per stage latency histograms, exposed in
+    the Prometheus text format
+"""
+
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from config import logger
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """ Cumulative latency histogram, in seconds
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    """ Thread safe counters and histograms of a run
+    """
+
+    def __init__(self, prefix="odpckan"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.server = None
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """ Observe the duration of the block, also if it fails.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(self, stage):
+        """ Decorator observing the duration of each call.
+        """
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def render(self):
+        """ The metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                metric = "%s_%s_total" % (self.prefix, name)
+                lines.append("# TYPE %s counter" % metric)
+                lines.append("%s %s" % (metric, value))
+
+            metric = "%s_stage_seconds" % self.prefix
+            lines.append("# TYPE %s histogram" % metric)
+            for stage, h in sorted(self.histograms.items()):
+                for bound, count in zip(BUCKETS, h.buckets):
+                    lines.append(
+                        '%s_bucket{stage="%s",le="%s"} %s'
+                        % (metric, stage, bound, count)
+                    )
+                lines.append(
+                    '%s_bucket{stage="%s",le="+Inf"} %s'
+                    % (metric, stage, h.count)
+                )
+                lines.append('%s_sum{stage="%s"} %s' % (metric, stage, h.sum))
+                lines.append(
+                    '%s_count{stage="%s"} %s' % (metric, stage, h.count)
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """ Write the metrics to a file, e.g. for the node exporter textfile
+            collector. The file is replaced atomically.
+        """
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port):
+        """ Serve the metrics over HTTP on `port`, from a daemon thread.
+        """
+        if self.server is not None:
+            return
+        import http.server
+
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info("Serving metrics on port %s", port)
+
+    def log_summary(self):
+        with self.lock:
+            logger.info(
+                "SUMMARY after %.1fs: %s",
+                time.time() - self.started,
+                ", ".join(
+                    "%s=%s" % item for item in sorted(self.counters.items())
+                )
+                or "no messages",
+            )
+            for stage, h in sorted(self.histograms.items()):
+                logger.info(
+                    "SUMMARY %s: %s calls, avg %.3fs, max %.3fs, total %.1fs",
+                    stage,
+                    h.count,
+                    h.sum / h.count,
+                    h.max,
+                    h.sum,
+                )
+
+
+metrics = Metrics()
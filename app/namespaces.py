@@ -0,0 +1,31 @@
+""" Namespaces - the RDF vocabularies of the SDS and ODP data
+"""
+
+from rdflib import Namespace
+
+DCAT = Namespace("http://www.w3.org/ns/dcat#")
+VCARD = Namespace("http://www.w3.org/2006/vcard/ns#")
+ADMS = Namespace("http://www.w3.org/ns/adms#")
+SCHEMA = Namespace("http://schema.org/")
+EU_FILE_TYPE = Namespace(
+    "http://publications.europa.eu/resource/authority/file-type/"
+)
+EU_DISTRIBUTION_TYPE = Namespace(
+    "http://publications.europa.eu/resource/authority/distribution-type/"
+)
+EU_LICENSE = Namespace(
+    "http://publications.europa.eu/resource/authority/licence/"
+)
+EU_STATUS = Namespace(
+    "http://publications.europa.eu/resource/authority/dataset-status/"
+)
+EU_COUNTRY = Namespace(
+    "http://publications.europa.eu/resource/authority/country/"
+)
+EUROVOC = Namespace("http://eurovoc.europa.eu/")
+ECODP = Namespace("http://open-data.europa.eu/ontologies/ec-odp#")
+DAVIZ = Namespace("http://www.eea.europa.eu/portal_types/DavizVisualization#")
+GIS = Namespace("http://www.eea.europa.eu/portal_types/GIS%%20Application#")
+EEAFIGURE = Namespace("http://www.eea.europa.eu/portal_types/EEAFigure#")
+DASHBOARD = Namespace("http://www.eea.europa.eu/portal_types/Dashboard#")
+INFOGRAPHIC = Namespace("http://www.eea.europa.eu/portal_types/Infographic#")
@@ -3,9 +3,15 @@
     ODP (https://open-data.europa.eu/en/data/publisher/eea)
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 import ckanapi
 
+from backpressure import breakers
 from config import logger, ckan_config
+from metrics import metrics
 
 
 class ODPClient:
@@ -37,6 +43,8 @@ class ODPClient:
         )
         logger.info("Connected to %s" % self.__address)
 
+    @metrics.timed("package_save")
+    @breakers["odp"].protect(ignore=(ckanapi.errors.ValidationError,))
     def package_save(self, ckan_uri, ckan_rdf):
         """ Save a package
         """
@@ -52,6 +60,8 @@ class ODPClient:
         }
         return self.conn.call_action("package_save", data_dict=envelope)
 
+    @metrics.timed("package_show")
+    @breakers["odp"].protect()
     def package_show(self, package_name):
         """ Get the package by name
         """
@@ -60,16 +70,38 @@ class ODPClient:
         except ckanapi.errors.NotFound:
             return None
 
-    def package_search(self, fq):
-        start = 0
-        while True:
-            resp = self.conn.action.package_search(
-                fq=fq, output_format="json", start=start,
-            )
+    @breakers["odp"].protect()
+    def search_page(self, fq, start, rows):
+        return self.conn.action.package_search(
+            fq=fq, output_format="json", start=start, rows=rows,
+        )
 
-            if not resp["results"]:
-                return
+    def package_search(self, fq, rows=None, workers=None):
+        """ Search packages, yields them in order. The first page gives the
+            total count, the next ones are fetched by `workers` threads,
+            up to `workers` pages ahead of the one being read.
+        """
+        rows = rows or ckan_config["ckan_search_rows"]
+        workers = workers or ckan_config["ckan_search_workers"]
+        resp = self.search_page(fq, 0, rows)
+        results = resp["results"]
+        yield from results
+        if not results:
+            return
 
-            for item in resp["results"]:
-                yield item
-                start += 1
+        # ODP may return less than `rows` items per page
+        page_size = len(results)
+        starts = iter(range(page_size, resp["count"], page_size))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = deque(
+                executor.submit(self.search_page, fq, start, rows)
+                for start in islice(starts, workers)
+            )
+            while pages:
+                results = pages.popleft().result()["results"]
+                start = next(starts, None)
+                if start is not None:
+                    pages.append(
+                        executor.submit(self.search_page, fq, start, rows)
+                    )
+                yield from results
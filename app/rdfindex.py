@@ -0,0 +1,128 @@
+""" RDF index - a light alternative to rdflib's Graph for reading the flat
+    RDF/XML that SDS returns
+"""
+
+import io
+from xml.etree.ElementTree import iterparse
+
+from rdflib import BNode, Literal, URIRef
+
+RDF_NS = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+RDF_RDF = "{%s}RDF" % RDF_NS
+RDF_DESCRIPTION = "{%s}Description" % RDF_NS
+RDF_ABOUT = "{%s}about" % RDF_NS
+RDF_NODE_ID = "{%s}nodeID" % RDF_NS
+RDF_RESOURCE = "{%s}resource" % RDF_NS
+RDF_DATATYPE = "{%s}datatype" % RDF_NS
+RDF_PARSE_TYPE = "{%s}parseType" % RDF_NS
+RDF_TYPE = URIRef(RDF_NS + "type")
+XML_LANG = "{%s}lang" % XML_NS
+
+# the attributes read on the node and property elements, the others (property
+# attributes, rdf:ID, xml:base, ...) are rejected rather than dropped
+NODE_ATTRIBUTES = {RDF_ABOUT, RDF_NODE_ID, XML_LANG}
+PROPERTY_ATTRIBUTES = {
+    RDF_RESOURCE,
+    RDF_NODE_ID,
+    RDF_DATATYPE,
+    RDF_PARSE_TYPE,
+    XML_LANG,
+}
+
+
+def element_uri(tag):
+    """ '{http://ns#}name' -> URIRef('http://ns#name')
+    """
+    namespace, name = tag[1:].split("}", 1)
+    return URIRef(namespace + name)
+
+
+def check_attributes(elem, supported):
+    """ Raise `ValueError` if `elem` has an attribute not in `supported`
+    """
+    for name in elem.attrib:
+        if name not in supported:
+            raise ValueError(
+                "Unsupported attribute %r on %r" % (name, elem.tag)
+            )
+
+
+class RDFIndex:
+    """ Triples of a RDF/XML document indexed by subject and predicate.
+        Supports the `objects` and `value` lookups of `rdflib.Graph`,
+        without building a full graph store. The document is read with
+        `iterparse`, one top level node at a time. The RDF/XML syntax it
+        does not support raises `ValueError`.
+    """
+
+    def __init__(self, data):
+        self.index = {}
+        self.bnodes = {}
+        depth = 0
+        source = io.BytesIO(data.encode("utf-8"))
+        for event, elem in iterparse(source, events=("start", "end")):
+            if event == "start":
+                if depth == 0:
+                    check_attributes(elem, ())
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 1:
+                self.parse_node(elem, elem.get(XML_LANG))
+                elem.clear()
+
+    def add(self, s, p, o):
+        # dict keys keep the order and drop duplicate triples
+        self.index.setdefault(s, {}).setdefault(p, {})[o] = None
+
+    def node_id(self, node_id):
+        if node_id not in self.bnodes:
+            self.bnodes[node_id] = BNode()
+        return self.bnodes[node_id]
+
+    def parse_node(self, elem, lang):
+        """ Add the triples of a node element and returns its subject.
+        """
+        check_attributes(elem, NODE_ATTRIBUTES)
+        if elem.get(RDF_ABOUT) is not None:
+            subject = URIRef(elem.get(RDF_ABOUT))
+        elif elem.get(RDF_NODE_ID) is not None:
+            subject = self.node_id(elem.get(RDF_NODE_ID))
+        else:
+            subject = BNode()
+
+        if elem.tag != RDF_DESCRIPTION:
+            self.add(subject, RDF_TYPE, element_uri(elem.tag))
+
+        lang = elem.get(XML_LANG, lang)
+        for prop in elem:
+            obj = self.parse_object(prop, lang)
+            self.add(subject, element_uri(prop.tag), obj)
+        return subject
+
+    def parse_object(self, prop, lang):
+        check_attributes(prop, PROPERTY_ATTRIBUTES)
+        if prop.get(RDF_PARSE_TYPE) is not None:
+            raise ValueError(
+                "Unsupported rdf:parseType %r" % prop.get(RDF_PARSE_TYPE)
+            )
+        if prop.get(RDF_RESOURCE) is not None:
+            return URIRef(prop.get(RDF_RESOURCE))
+        if prop.get(RDF_NODE_ID) is not None:
+            return self.node_id(prop.get(RDF_NODE_ID))
+        children = list(prop)
+        if children:
+            return self.parse_node(children[0], prop.get(XML_LANG, lang))
+        text = prop.text or ""
+        datatype = prop.get(RDF_DATATYPE)
+        if datatype is not None:
+            return Literal(text, datatype=URIRef(datatype))
+        return Literal(text, lang=prop.get(XML_LANG, lang))
+
+    def objects(self, subject, predicate):
+        return iter(self.index.get(subject, {}).get(predicate, ()))
+
+    def value(self, subject, predicate):
+        return next(self.objects(subject, predicate), None)
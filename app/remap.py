@@ -15,6 +15,11 @@ temporary files::
     python remap.py download
     python remap.py match_datasets
 
+The datasets are kept in ``mirror.db`` in that directory; a new ``download``
+only saves the ones modified since.
+The redirects followed to match the datasets are kept in ``redirects.db`` in
+the same directory, a new ``match_datasets`` run only requests the others.
+
 2. Generate a CSV with a mapping between old and new::
 
     python remap.py old_new_mapping > /tmp/dataset_mapping.csv
@@ -22,6 +27,11 @@ temporary files::
 3. Re-publish the old datasets as "obsolete"::
 
     python remap.py mark_obsolete
+
+The datasets are published by ``REMAP_WORKERS`` threads (``--workers``). The
+outcome of each one is kept in ``journal.db``; a new run skips the datasets
+already published, unless ``--restart``. ``--dump DIR`` writes the RDF of
+each dataset in DIR.
 """
 
 import sys
@@ -30,21 +40,40 @@ import json
 import argparse
 from pathlib import Path
 import csv
-
-import requests
+import hashlib
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from config import logger, other_config
 from ckanclient import CKANClient
-from sdsclient import EU_STATUS
+from sdsclient import EU_STATUS, make_session
+from store import JournalStore, MirrorStore, RedirectCache
+
+
+def sds_url(dataset_url):
+    """ The URL of a dataset as it is known by SDS, always http
+    """
+    if dataset_url.startswith("https"):
+        return dataset_url.replace("https", "http", 1)
+    return dataset_url
 
 
 class RemapDatasets:
 
     odp_uri_prefix = "http://data.europa.eu/88u/dataset/"
+    max_redirects = 30
 
     def __init__(self, repo):
         self.repo = repo
         self.datasets_csv = self.repo / "datasets.csv"
+        self.mirror = MirrorStore(self.repo / "mirror.db")
+        self.redirects = RedirectCache(self.repo / "redirects.db")
+        self.journal = JournalStore(self.repo / "journal.db")
+        self.session = make_session(
+            other_config["pool_size"],
+            other_config["retries"],
+            other_config["backoff"],
+        )
 
         self.cc = CKANClient("odp_queue")
         self.odp = self.cc.odp
@@ -56,37 +85,92 @@ class RemapDatasets:
                 "value"
             ]
 
-    def download(self):
+    def get_version(self, item):
+        """ `metadata_modified` of the package, or a hash of its content
+        """
+        if item.get("metadata_modified"):
+            return item["metadata_modified"]
+        dump = json.dumps(item, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(dump).hexdigest()
+
+    def download(self, batch_size=100):
+        """ Update the mirror with the EEA packages in ODP. Only the new and
+            modified ones are saved, `batch_size` at a time; the ones no
+            longer in ODP are removed.
+        """
+        versions = self.mirror.versions()
+        seen = set()
+        batch = []
+        saved = 0
         for n, item in enumerate(
             self.odp.package_search(fq="organization:eea")
         ):
             uri = item["dataset"]["uri"]
             assert uri.startswith(self.odp_uri_prefix)
             id = uri[len(self.odp_uri_prefix):]
+            seen.add(id)
+            version = self.get_version(item)
+            if versions.get(id) == version:
+                continue
             print(n, id)
-            with (self.repo / (id + ".json")).open("w", encoding="utf8") as f:
-                f.write(json.dumps(item, indent=2, sort_keys=True))
+            batch.append((id, version, item))
+            if len(batch) >= batch_size:
+                self.mirror.save(batch)
+                saved += len(batch)
+                batch = []
+        self.mirror.save(batch)
+        saved += len(batch)
+        deleted = set(versions) - seen
+        self.mirror.delete(deleted)
+        logger.info(
+            "DONE download: %s packages, %s saved, %s deleted",
+            len(seen),
+            saved,
+            len(deleted),
+        )
 
     def resolve_url(self, url):
-        while True:
-            resp = requests.head(url)
-            if not resp.is_redirect:
+        """ Follow the redirects from `url`, returns the final URL. Every
+            hop is kept in `self.redirects`. Raises on a server error, which
+            is not kept.
+        """
+        for _ in range(self.max_redirects):
+            found, location = self.redirects.get(url)
+            if not found:
+                resp = self.session.head(
+                    url,
+                    timeout=(
+                        other_config["connect_timeout"],
+                        other_config["timeout"],
+                    ),
+                )
+                if not resp.is_redirect and resp.status_code >= 500:
+                    # a server error is not an answer, try again next run
+                    resp.raise_for_status()
+                location = resp.next.url if resp.is_redirect else None
+                self.redirects.set(url, location)
+            if location is None:
                 return url
-            url = resp.next.url
+            url = location
+        raise RuntimeError("Too many redirects for %r" % url)
+
+    def try_resolve_url(self, url):
+        try:
+            return self.resolve_url(url)
+        except Exception:
+            logger.exception("Could not resolve %r", url)
+            return url
 
     def iter_datasets(self):
-        for p in self.repo.iterdir():
-            if not p.name.endswith(".json"):
-                continue
-            with p.open(encoding="utf8") as f:
-                item = json.load(f)
-            yield item
+        return self.mirror.iter_packages()
 
     def match_datasets(self):
         with self.datasets_csv.open("w", encoding="utf-8") as f:
             writer = csv.writer(f)
             writer.writerow(["ckan_uri", "product_id", "url"])
 
+            # (uri, landing_page, url) of the datasets to find by redirects
+            unresolved = []
             for item in self.iter_datasets():
                 uri = item["dataset"]["uri"]
 
@@ -109,18 +193,24 @@ class RemapDatasets:
                                    uri, landing_page)
                     continue
 
-                url = self.resolve_url(url)
-                url = re.sub(r"^https://", "http://", url)
-                if url in self.product_id_map:
-                    writer.writerow([uri, self.product_id_map[url], url])
-                    continue
+                unresolved.append((uri, landing_page, url))
 
-                logger.warning(
-                    "Could not find product_id for dataset: "
-                    "%r, landing page: %r",
-                    uri,
-                    landing_page,
+            with ThreadPoolExecutor(other_config["remap_workers"]) as pool:
+                urls = pool.map(
+                    self.try_resolve_url, [url for _, _, url in unresolved]
                 )
+                for (uri, landing_page, _), url in zip(unresolved, urls):
+                    url = re.sub(r"^https://", "http://", url)
+                    if url in self.product_id_map:
+                        writer.writerow([uri, self.product_id_map[url], url])
+                        continue
+
+                    logger.warning(
+                        "Could not find product_id for dataset: "
+                        "%r, landing page: %r",
+                        uri,
+                        landing_page,
+                    )
 
     def old_new_mapping(self):
         current = set()
@@ -146,8 +236,16 @@ class RemapDatasets:
             for s, d in mapping.items():
                 writer.writerow([s, d])
 
-    def mark_obsolete(self):
+    def mark_obsolete(self, workers=None, restart=False, dump_dir=None):
+        """ Publish the old datasets as obsolete, with `workers` threads.
+            The datasets published by a previous run are skipped, unless
+            `restart`. Returns the number of datasets that failed.
+        """
+        if restart:
+            self.journal.clear("mark_obsolete")
+        done = self.journal.done("mark_obsolete")
         product_ids = set(self.product_id_map.values())
+        todo = []
         with self.datasets_csv.open(encoding="utf-8") as f:
             reader = csv.DictReader(f)
             for row in reader:
@@ -163,17 +261,60 @@ class RemapDatasets:
                     logger.warning("Dataset %r is current, skipping", ckan_uri)
                     continue
 
-                self.publish_dataset(url, ckan_uri)
+                if ckan_uri in done:
+                    logger.info("Dataset %r already published", ckan_uri)
+                    continue
 
-    def publish_dataset(self, dataset_url, ckan_uri):
-        """ Publish dataset to ODP
+                todo.append((url, ckan_uri))
+
+        def publish(item):
+            url, ckan_uri = item
+            try:
+                data = prefetched.get(sds_url(url))
+                self.publish_dataset(url, ckan_uri, dump_dir, data)
+            except Exception:
+                logger.exception("Could not publish %r", ckan_uri)
+                self.journal.set(
+                    "mark_obsolete", ckan_uri, traceback.format_exc()
+                )
+                return False
+            self.journal.set("mark_obsolete", ckan_uri)
+            return True
+
+        workers = workers or other_config["remap_workers"]
+        batch_size = other_config["batch_size"]
+        failed = 0
+        with ThreadPoolExecutor(workers) as pool:
+            for start in range(0, len(todo), batch_size):
+                chunk = todo[start:start + batch_size]
+                # one SDS query for the chunk, the datasets missing from it
+                # are queried again one by one by `publish_dataset`
+                try:
+                    prefetched = self.sds.get_datasets(
+                        [sds_url(url) for url, _ in chunk],
+                        check_obsolete=False,
+                    )
+                except Exception:
+                    logger.exception("Could not query %s datasets", len(chunk))
+                    prefetched = {}
+                failed += list(pool.map(publish, chunk)).count(False)
+        logger.info(
+            "DONE mark_obsolete: %s published, %s failed",
+            len(todo) - failed,
+            failed,
+        )
+        return failed
+
+    def publish_dataset(self, dataset_url, ckan_uri, dump_dir=None, data=None):
+        """ Publish dataset to ODP, and write its RDF in `dump_dir`. SDS is
+            queried unless its `data` was already fetched.
         """
         logger.info("publish obsolete dataset '%s'", dataset_url)
 
-        if dataset_url.startswith("https"):
-            dataset_url = dataset_url.replace("https", "http", 1)
-
-        data = self.sds.get_dataset(dataset_url, check_obsolete=False)
+        if data is None:
+            data = self.sds.get_dataset(
+                sds_url(dataset_url), check_obsolete=False
+            )
         data["uri"] = ckan_uri
 
         data["status"] = str(EU_STATUS.DEPRECATED)
@@ -185,14 +326,30 @@ class RemapDatasets:
             data["issued"] = data["metadata_modified"]
 
         ckan_rdf = self.cc.render_ckan_rdf(data)
-        with open("/tmp/publish.rdf", "w", encoding="utf-8") as f:
-            f.write(ckan_rdf)
+        if dump_dir is not None:
+            identifier = ckan_uri.split("/")[-1]
+            path = Path(dump_dir) / (identifier + ".rdf")
+            path.write_text(ckan_rdf, encoding="utf-8")
         self.odp.package_save(ckan_uri, ckan_rdf)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Remap datasets")
     parser.add_argument("action")
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help="mark_obsolete: datasets published concurrently",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="mark_obsolete: publish again the datasets of previous runs",
+    )
+    parser.add_argument(
+        "--dump", help="mark_obsolete: write the RDF of each dataset in DUMP"
+    )
 
     args = parser.parse_args()
 
@@ -210,7 +367,8 @@ if __name__ == "__main__":
         rd.old_new_mapping()
 
     elif args.action == "mark_obsolete":
-        rd.mark_obsolete()
+        if rd.mark_obsolete(args.workers, args.restart, args.dump):
+            sys.exit(1)
 
     else:
         raise RuntimeError("Unknown action %r" % args.action)
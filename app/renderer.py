@@ -0,0 +1,213 @@
+""" Renderer - build the RDF/XML of a dataset for the ODP API
+"""
+
+from pathlib import Path
+
+import jinja2
+from markupsafe import escape
+
+TEMPLATES = Path(__file__).resolve().parent / "templates"
+
+ENVI = "http://publications.europa.eu/resource/authority/data-theme/ENVI"
+EEA = "http://publications.europa.eu/resource/authority/corporate-body/EEA"
+CC_BY = "http://publications.europa.eu/resource/authority/licence/CC_BY_4_0"
+DATETIME = "http://www.w3.org/2001/XMLSchema#dateTime"
+DOCUMENT = "http://data.europa.eu/88u/document/"
+DISTRIBUTION = "http://data.europa.eu/88u/distribution/"
+VCARD = "http://www.w3.org/2006/vcard/ns#"
+
+DATASET_FIELDS = [
+    "uri",
+    "title",
+    "description",
+    "product_id",
+    "issued",
+    "metadata_modified",
+    "status",
+    "landing_page",
+]
+RESOURCE_FIELDS = [
+    "_uuid",
+    "title",
+    "description",
+    "filetype",
+    "distribution_type",
+    "url",
+    "status",
+]
+
+
+class TemplateRenderer:
+    """ Renders "templates/ckan_package.rdf.xml". The template is compiled
+        once; with `cache_dir` the compiled code is also kept on disk, for
+        the next processes.
+    """
+
+    template_name = "ckan_package.rdf.xml"
+
+    def __init__(self, cache_dir=None):
+        bytecode_cache = None
+        if cache_dir:
+            bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+        env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(searchpath=str(TEMPLATES)),
+            autoescape=jinja2.select_autoescape(["html", "xml"]),
+            auto_reload=False,
+            bytecode_cache=bytecode_cache,
+        )
+        self.template = env.get_template(self.template_name)
+
+    def render(self, context):
+        return self.template.render(context)
+
+
+class DirectRenderer:
+    """ Writes the same RDF/XML as `TemplateRenderer` with string
+        formatting, without the template engine.
+    """
+
+    def render(self, context):
+        # missing values render empty, as undefined ones in the template
+        c = {k: escape(context.get(k, "")) for k in DATASET_FIELDS}
+        uuids = context["uuids"]
+        resources = [
+            {k: escape(r.get(k, "")) for k in RESOURCE_FIELDS}
+            for r in context.get("resources", [])
+        ]
+        parts = [
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            "<rdf:RDF\n"
+            '   xmlns:adms="http://www.w3.org/ns/adms#"\n'
+            '   xmlns:dcat="http://www.w3.org/ns/dcat#"\n'
+            '   xmlns:dcatapop='
+            '"http://data.europa.eu/88u/ontology/dcatapop#"\n'
+            '   xmlns:dcterms="http://purl.org/dc/terms/"\n'
+            '   xmlns:foaf="http://xmlns.com/foaf/0.1/"\n'
+            '   xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"\n'
+            '   xmlns:schema="http://schema.org/"\n'
+            '   xmlns:vcard="http://www.w3.org/2006/vcard/ns#"\n'
+            ">\n\n",
+            '  <rdf:Description rdf:about="%s">\n' % c["uri"],
+            '    <dcterms:title xml:lang="en">%s</dcterms:title>\n'
+            % c["title"],
+            '    <dcat:theme rdf:resource="%s"/>\n' % ENVI,
+            '    <dcterms:description xml:lang="en">%s</dcterms:description>\n'
+            % c["description"],
+            '    <dcterms:publisher rdf:resource="%s"/>\n' % EEA,
+            "    <dcterms:identifier>%s</dcterms:identifier>\n"
+            % c["product_id"],
+            '    <dcterms:issued rdf:datatype="%s">%s</dcterms:issued>\n'
+            % (DATETIME, c["issued"]),
+            '    <dcterms:modified rdf:datatype="%s">%s</dcterms:modified>\n'
+            % (DATETIME, c["metadata_modified"]),
+            '    <dcat:contactPoint rdf:resource="%sKind/%s"/>\n'
+            % (VCARD, escape(uuids["contact"])),
+            '    <dcat:landingPage rdf:resource="%s%s" />\n\n'
+            % (DOCUMENT, escape(uuids["landing_page"])),
+            '    <adms:status rdf:resource="%s"/>' % c["status"],
+        ]
+        for keyword in context.get("keywords", []):
+            parts.append(
+                "\n    <dcat:keyword>%s</dcat:keyword>" % escape(keyword)
+            )
+        for concept in context.get("concepts_eurovoc", []):
+            parts.append(
+                '\n    <dcterms:subject rdf:resource="%s"/>' % escape(concept)
+            )
+        for item in context.get("geographical_coverage", []):
+            parts.append(
+                '\n    <dcterms:spatial rdf:resource="%s"/>' % escape(item)
+            )
+        for r in resources:
+            parts.append(
+                '\n    <dcat:distribution rdf:resource="%s%s"/>'
+                % (DISTRIBUTION, r["_uuid"])
+            )
+        parts.append("\n  </rdf:Description>")
+        for r in resources:
+            parts.append(
+                "\n\n"
+                '  <rdf:Description rdf:about="%s%s">\n'
+                '    <rdf:type rdf:resource="http://www.w3.org/ns/dcat#'
+                'Distribution" />\n'
+                '    <dcterms:title xml:lang="en">%s</dcterms:title>\n'
+                "    <dcterms:description>%s</dcterms:description>\n"
+                '    <dcterms:format rdf:resource="%s" />\n'
+                '    <dcterms:type rdf:resource="%s" />\n'
+                '    <dcat:accessURL rdf:resource="%s" />\n'
+                '    <dcterms:license rdf:resource="%s" />\n'
+                '    <adms:status rdf:resource="%s"/>\n'
+                "  </rdf:Description>"
+                % (
+                    DISTRIBUTION,
+                    r["_uuid"],
+                    r["title"],
+                    r["description"],
+                    r["filetype"],
+                    r["distribution_type"],
+                    r["url"],
+                    CC_BY,
+                    r["status"],
+                )
+            )
+        parts.append(
+            "\n\n"
+            '  <rdf:Description rdf:about="%(document)s%(landing_page_id)s">\n'
+            '    <dcterms:type rdf:resource="default_type_dcterms"/>\n'
+            "    <schema:url>%(landing_page)s</schema:url>\n"
+            '    <rdf:type rdf:resource="%(foaf)sDocument"/>\n'
+            '    <foaf:topic rdf:resource="%(uri)s"/>\n'
+            '    <dcterms:title xml:lang="en">%(title)s</dcterms:title>\n'
+            "  </rdf:Description>\n\n"
+            '  <rdf:Description rdf:about="%(vcard)sKind/%(contact)s">\n'
+            '    <rdf:type rdf:resource="%(vcard)sKind"/>\n'
+            "    <vcard:organisation-name>European Environment Agency"
+            "</vcard:organisation-name>\n"
+            '    <foaf:homepage rdf:resource="%(document)s%(homepage)s"/>\n'
+            '    <vcard:hasTelephone rdf:resource="%(vcard)sVoice/%(tel)s"/>\n'
+            '    <vcard:hasAddress'
+            ' rdf:resource="%(vcard)sAddress/%(addr)s"/>\n'
+            "  </rdf:Description>\n\n"
+            '  <rdf:Description rdf:about="%(document)s%(homepage)s">\n'
+            '    <dcterms:type rdf:resource="default_type_dcterms"/>\n'
+            '    <rdf:type rdf:resource="%(foaf)sDocument"/>\n'
+            "    <schema:url>https://www.eea.europa.eu</schema:url>\n"
+            '    <foaf:topic rdf:resource="default_topic_foaf"/>\n'
+            '    <dcterms:title xml:lang="en">European Environment Agency'
+            "</dcterms:title>\n"
+            "  </rdf:Description>\n\n"
+            '  <rdf:Description rdf:about="%(vcard)sVoice/%(tel)s">\n'
+            '    <rdf:type rdf:resource="%(vcard)sVoice"/>\n'
+            '    <vcard:hasValue rdf:resource="tel:+4533367100"/>\n'
+            "  </rdf:Description>\n\n"
+            '  <rdf:Description rdf:about="%(vcard)sAddress/%(addr)s">\n'
+            '    <rdf:type rdf:resource="%(vcard)sAddress"/>\n'
+            "    <vcard:street-address>Kongens Nytorv 6, 1050 Copenhagen K, "
+            "Denmark</vcard:street-address>\n"
+            "  </rdf:Description>\n\n"
+            "</rdf:RDF>"
+            % {
+                "document": DOCUMENT,
+                "vcard": VCARD,
+                "foaf": "http://xmlns.com/foaf/0.1/",
+                "uri": c["uri"],
+                "title": c["title"],
+                "landing_page": c["landing_page"],
+                "landing_page_id": escape(uuids["landing_page"]),
+                "contact": escape(uuids["contact"]),
+                "homepage": escape(uuids["contact_homepage"]),
+                "tel": escape(uuids["contact_telephone"]),
+                "addr": escape(uuids["contact_address"]),
+            }
+        )
+        return "".join(parts)
+
+
+def make_renderer(engine="template", cache_dir=None):
+    """ The renderer for `engine`, "template" or "direct"
+    """
+    if engine == "template":
+        return TemplateRenderer(cache_dir)
+    if engine == "direct":
+        return DirectRenderer()
+    raise ValueError("Unknown renderer %r" % engine)
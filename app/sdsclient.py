@@ -3,44 +3,25 @@
 """
 
 import argparse
+import hashlib
 import json
 import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
-import requests
-from rdflib import Graph, URIRef, Namespace
-from rdflib.namespace import DCTERMS, RDF
+import pika
 from eea.rabbitmq.client import RabbitMQConnector
 
+from backpressure import breakers
 from config import logger, services_config, rabbit_config, other_config
-from odpclient import ODPClient
-
-DCAT = Namespace("http://www.w3.org/ns/dcat#")
-VCARD = Namespace("http://www.w3.org/2006/vcard/ns#")
-ADMS = Namespace("http://www.w3.org/ns/adms#")
-SCHEMA = Namespace("http://schema.org/")
-EU_FILE_TYPE = Namespace(
-    "http://publications.europa.eu/resource/authority/file-type/"
-)
-EU_DISTRIBUTION_TYPE = Namespace(
-    "http://publications.europa.eu/resource/authority/distribution-type/"
-)
-EU_LICENSE = Namespace(
-    "http://publications.europa.eu/resource/authority/licence/"
-)
-EU_STATUS = Namespace(
-    "http://publications.europa.eu/resource/authority/dataset-status/"
-)
-EU_COUNTRY = Namespace(
-    "http://publications.europa.eu/resource/authority/country/"
-)
-EUROVOC = Namespace("http://eurovoc.europa.eu/")
-ECODP = Namespace("http://open-data.europa.eu/ontologies/ec-odp#")
-DAVIZ = Namespace("http://www.eea.europa.eu/portal_types/DavizVisualization#")
-GIS = Namespace("http://www.eea.europa.eu/portal_types/GIS%%20Application#")
-EEAFIGURE = Namespace("http://www.eea.europa.eu/portal_types/EEAFigure#")
-DASHBOARD = Namespace("http://www.eea.europa.eu/portal_types/Dashboard#")
-INFOGRAPHIC = Namespace("http://www.eea.europa.eu/portal_types/Infographic#")
+from metrics import metrics
+from sparql import get_query
+from store import CheckpointStore, LatestVersionStore, ResponseCache
 
+# rdflib, requests and ckanapi are imported where they are used, so that
+# the command line tools start fast when they have nothing to do
 
 FILE_TYPES = {
     "application/msaccess": "MDB",
@@ -69,16 +50,100 @@ FILE_TYPES = {
 }
 
 
+def __getattr__(name):
+    """ The namespaces, moved to `namespaces`, are still available here.
+    """
+    if name.isupper():
+        import namespaces
+
+        if hasattr(namespaces, name):
+            return getattr(namespaces, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def bulk_queue_name(queue_name):
+    """ The lower priority queue for the messages sent by the bulk updates
+    """
+    return queue_name + "_bulk"
+
+
+def make_session(pool_size, retries, backoff):
+    """ A `requests.Session` keeping up to `pool_size` connections alive
+        per host, retrying connection errors and 5xx responses with
+        exponential backoff. Read timeouts are not retried, a query that
+        hangs would hang again.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=retries,
+        read=False,
+        backoff_factor=backoff,
+        status_forcelist=[500, 502, 503, 504],
+        method_whitelist=frozenset(["GET", "HEAD", "POST"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 class SDSClient:
     """ SDS client
     """
 
+    # seconds to wait before refreshing the version index again after a
+    # failure
+    refresh_retry = 60
+
     def __init__(self, endpoint, timeout, queue_name, odp):
         """ """
         self.endpoint = endpoint
         self.timeout = timeout
         self.queue_name = queue_name
+        self.bulk_queue_name = bulk_queue_name(queue_name)
+        # messages per transaction, one page of datasets by default
+        self.publish_batch = (
+            other_config["publish_batch"] or other_config["page_size"]
+        )
         self.odp = odp
+        self.session = make_session(
+            other_config["pool_size"],
+            other_config["retries"],
+            other_config["backoff"],
+        )
+        self.cache = None
+        if other_config["sds_cache"]:
+            self.cache = ResponseCache(
+                other_config["sds_cache"],
+                other_config["sds_cache_size"] * 1024 * 1024,
+            )
+        self.cache_ttl = other_config["sds_cache_ttl"]
+        # per thread flag set by `revalidate`
+        self.local = threading.local()
+        self.parser = other_config["parser"]
+        self.version_index_ttl = other_config["version_index_ttl"]
+        self.version_index = None
+        self.version_index_built = None
+        self.version_index_lock = threading.Lock()
+        # the refresh running in the background, if any
+        self.version_index_thread = None
+        # no refresh is tried before this time, after one failed
+        self.version_index_retry = 0
+        self.version_store = None
+        self.checkpoints = None
+        # seconds before the start of an update where the next incremental
+        # update starts, for the changes harvested by SDS with a delay
+        self.watermark_overlap = other_config["watermark_overlap"]
+        if other_config["state_db"]:
+            self.version_store = LatestVersionStore(other_config["state_db"])
+            self.checkpoints = CheckpointStore(other_config["state_db"])
 
     def parse_datasets_json(self, datasets_json):
         """ Parses a response with datasets from SDS in JSON format.
@@ -90,12 +155,74 @@ class SDSClient:
             r.append((dataset_url, product_id))
         return r
 
+    @contextmanager
+    def revalidate(self):
+        """ Within the block, the queries of the current thread always ask
+            SDS: the cached responses are only used if SDS answers that they
+            did not change. For the queue consumer, where a message means
+            that the dataset was just edited.
+        """
+        self.local.revalidate = True
+        try:
+            yield
+        finally:
+            self.local.revalidate = False
+
+    @metrics.timed("sds_query")
     def query_sds(self, query, format):
         """ Generic method to query SDS to be used all around.
+            Responses are cached for `cache_ttl` seconds when `cache` is
+            set (not within `revalidate`), then revalidated with the
+            ETag/Last-Modified headers.
+            The requests go through the "sds" circuit breaker.
         """
         data = {"query": query, "format": format}
         headers = {"Accept": format}
-        resp = requests.post(self.endpoint, data=data, headers=headers)
+
+        entry = None
+        if self.cache is not None:
+            key = "%s\n%s\n%s" % (self.endpoint, format, query)
+            key = hashlib.sha256(key.encode("utf-8")).hexdigest()
+            entry = self.cache.get(key)
+            if entry is not None:
+                text, etag, last_modified, created = entry
+                if time.time() - created < self.cache_ttl and not getattr(
+                    self.local, "revalidate", False
+                ):
+                    metrics.inc("sds_cache_hits")
+                    return text
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+
+        def post():
+            resp = self.session.post(
+                self.endpoint,
+                data=data,
+                headers=headers,
+                timeout=(other_config["connect_timeout"], self.timeout),
+            )
+            # only the server errors count as failures of SDS
+            if resp.status_code >= 500:
+                resp.raise_for_status()
+            return resp
+
+        resp = breakers["sds"].call(post)
+        if entry is not None and resp.status_code == 304:
+            metrics.inc("sds_cache_revalidated")
+            self.cache.refresh(key)
+            return entry[0]
+        resp.raise_for_status()
+
+        if self.cache is not None:
+            metrics.inc("sds_cache_misses")
+            self.cache.set(
+                key,
+                resp.text,
+                resp.headers.get("ETag"),
+                resp.headers.get("Last-Modified"),
+            )
         return resp.text
 
     def query_dataset(self, dataset_url):
@@ -103,15 +230,93 @@ class SDSClient:
             about it and returns the result which is RDF.
         """
         logger.info("query dataset '%s'", dataset_url)
-        query = other_config["query_dataset"] % {"dataset": dataset_url}
+        query = get_query("query_datasets").render(datasets=[dataset_url])
         return self.query_sds(query, "application/xml")
 
+    def query_datasets(self, dataset_urls):
+        """ Same as `query_dataset`, for several datasets at once.
+        """
+        logger.info("query %s datasets", len(dataset_urls))
+        query = get_query("query_datasets").render(datasets=dataset_urls)
+        return self.query_sds(query, "application/xml")
+
+    def query_latest_versions(self):
+        """ Find the latest published version of all replaced datasets.
+            Returns a dict of dataset URL to latest version URL.
+        """
+        logger.info("query latest versions")
+        query = get_query("query_latest_versions").render()
+        resp = self.query_sds(query, "application/json")
+        return {
+            b["dataset"]["value"]: b["latest"]["value"]
+            for b in json.loads(resp)["results"]["bindings"]
+        }
+
+    def get_version_index(self, wait=False):
+        """ The result of `query_latest_versions`, kept in memory and in the
+            state database. After `version_index_ttl` seconds it is refreshed
+            in a background thread, and the old one is served meanwhile,
+            unless `wait`. Only a first call with nothing saved waits for
+            the query anyway.
+        """
+        with self.version_index_lock:
+            if self.version_index is None and self.version_store is not None:
+                index, built = self.version_store.load()
+                self.version_index, self.version_index_built = index, built
+            if self.version_index is None:
+                self.version_index = self.query_latest_versions()
+                self.version_index_built = time.time()
+                if self.version_store is not None:
+                    self.version_store.save(self.version_index)
+                return self.version_index
+            now = time.time()
+            refresh = (
+                now - self.version_index_built > self.version_index_ttl
+                and now >= self.version_index_retry
+                and self.version_index_thread is None
+            )
+            if refresh and not wait:
+                self.version_index_thread = threading.Thread(
+                    target=self.refresh_version_index, daemon=True
+                )
+                self.version_index_thread.start()
+        if refresh and wait:
+            self.refresh_version_index()
+        return self.version_index
+
+    def refresh_version_index(self):
+        """ Query the latest versions again and replace the version index.
+            After a failure the old index is kept, and no refresh is tried
+            for `refresh_retry` seconds.
+        """
+        try:
+            index = self.query_latest_versions()
+            if self.version_store is not None:
+                self.version_store.save(index)
+        except Exception:
+            logger.exception(
+                "Could not refresh the version index, retrying in %ss",
+                self.refresh_retry,
+            )
+            with self.version_index_lock:
+                self.version_index_retry = time.time() + self.refresh_retry
+                self.version_index_thread = None
+            return
+        with self.version_index_lock:
+            self.version_index = index
+            self.version_index_built = time.time()
+            self.version_index_thread = None
+
+    @metrics.timed("get_latest_version")
     def get_latest_version(self, dataset_url):
         """ Given a dataset URL interogates the SDS service
             and returns the latest version URI.
         """
+        if self.version_index_ttl:
+            return self.get_version_index().get(dataset_url, dataset_url)
+
         logger.info("query latest version '%s'", dataset_url)
-        query = other_config["query_latest_version"] % {"dataset": dataset_url}
+        query = get_query("query_latest_version").render(dataset=dataset_url)
         resp = self.query_sds(query, "application/json")
         bindings = json.loads(resp)["results"]["bindings"]
         if bindings:
@@ -119,19 +324,60 @@ class SDSClient:
         else:
             return dataset_url
 
-    def query_all_datasets(self):
-        """ Find all datasets (to pe updated in ODP) in the repository.
+    def query_all_datasets(self, after="", limit=None):
+        """ Find all datasets (to pe updated in ODP) in the repository,
+            one page of `limit` datasets with URLs sorted after `after`.
         """
-        logger.info("query all datasets")
-        query = other_config["query_all_datasets"]
+        limit = limit or other_config["page_size"]
+        logger.info("query all datasets after %r", after)
+        query = get_query("query_all_datasets").render(
+            after=after, limit=int(limit)
+        )
         result = self.query_sds(query, "application/json")
         return json.loads(result)
 
+    def iter_all_datasets(self, after="", page_size=None):
+        """ Yields the URLs of all datasets sorted after `after`, querying
+            SDS one page at a time.
+        """
+        page_size = page_size or other_config["page_size"]
+        while True:
+            result_json = self.query_all_datasets(after, page_size)
+            bindings = result_json["results"]["bindings"]
+            for item_json in bindings:
+                yield item_json["dataset"]["value"]
+            if len(bindings) < page_size:
+                return
+            after = bindings[-1]["dataset"]["value"]
+
+    def query_modified_datasets(self, since):
+        """ Find the datasets modified, or with files modified, after the
+            `since` xsd:dateTime. Returns `(dataset_url, last_modified)`
+            pairs.
+        """
+        logger.info("query datasets modified since %s", since)
+        query = get_query("query_modified_datasets").render(since=since)
+        result = json.loads(self.query_sds(query, "application/json"))
+        return [
+            (b["dataset"]["value"], b["last_modified"]["value"])
+            for b in result["results"]["bindings"]
+        ]
+
+    def new_watermark(self):
+        """ The xsd:dateTime from where the next incremental update starts,
+            taken before the datasets are read so no change is missed:
+            now, minus `watermark_overlap`.
+        """
+        moment = datetime.now(timezone.utc) - timedelta(
+            seconds=self.watermark_overlap
+        )
+        return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
     def query_replaces(self):
         """ Find which datasets replace other datasets
         """
         logger.info("query replaces")
-        query = other_config["query_replaces"]
+        query = get_query("query_replaces").render()
         result = self.query_sds(query, "application/json")
         return json.loads(result)
 
@@ -139,35 +385,80 @@ class SDSClient:
         rabbit = RabbitMQConnector(**rabbit_config)
         rabbit.open_connection()
         rabbit.declare_queue(self.queue_name)
+        rabbit.declare_queue(self.bulk_queue_name)
         return rabbit
 
+    def start_publishing(self, rabbit):
+        """ Make the publishing on the channel reliable: the messages are
+            sent in transactions, committed by `commit_published` every
+            `publish_batch` messages, one round trip per transaction.
+        """
+        rabbit.get_channel().tx_select()
+
+    def commit_published(self, rabbit):
+        """ Wait until the broker has all the messages sent so far.
+        """
+        rabbit.get_channel().tx_commit()
+
     def add_to_queue(
-        self, rabbit, action, dataset_url, dataset_identifier, counter=1
+        self,
+        rabbit,
+        action,
+        dataset_url,
+        dataset_identifier,
+        counter=1,
+        bulk=False,
     ):
+        """ Send a message to the queue, or to the lower priority bulk queue
+            if `bulk`. In a transaction (see `start_publishing`) the message
+            is only delivered once the transaction is committed.
+        """
+        queue_name = self.bulk_queue_name if bulk else self.queue_name
         body = "%(action)s|%(dataset_url)s|%(dataset_identifier)s" % {
             "action": action,
             "dataset_url": dataset_url,
             "dataset_identifier": dataset_identifier,
         }
-        logger.info(
+        logger.debug(
             "BULK update %s: sending '%s' in '%s'",
             counter,
             body,
-            self.queue_name,
+            queue_name,
+        )
+        rabbit.get_channel().basic_publish(
+            exchange="",
+            routing_key=queue_name,
+            body=body.encode("utf-8"),
+            properties=pika.BasicProperties(
+                delivery_mode=2, content_encoding="utf-8"
+            ),
         )
-        rabbit.send_message(self.queue_name, body)
 
-    def bulk_update(self):
+    def bulk_update(self, restart=False):
         """ Queries SDS for all datasets and injects messages in rabbitmq.
+            Progress is saved after each page of datasets, an interrupted
+            bulk update resumes after the last page sent unless `restart`.
         """
         logger.info("START bulk update")
-        result_json = self.query_all_datasets()
-        datasets_json = result_json["results"]["bindings"]
-        logger.info("BULK update: %s datasets found", len(datasets_json))
+        after = ""
+        watermark = None
+        if self.checkpoints is not None:
+            if not restart:
+                after = self.checkpoints.get("bulk_update") or ""
+            if after:
+                logger.info("RESUME bulk update after %r", after)
+                # taken when the interrupted run started
+                watermark = self.checkpoints.get("bulk_update_watermark")
+            else:
+                watermark = self.new_watermark()
+                self.checkpoints.set("bulk_update_watermark", watermark)
+
         rabbit = self.get_rabbit()
+        self.start_publishing(rabbit)
+        page_size = other_config["page_size"]
         counter = 1
-        for item_json in datasets_json:
-            dataset_url = item_json["dataset"]["value"]
+        dataset_url = None
+        for dataset_url in self.iter_all_datasets(after, page_size):
             action = "update"
             self.add_to_queue(
                 rabbit,
@@ -175,16 +466,99 @@ class SDSClient:
                 dataset_url,
                 "_fake_dataset_identifier_",
                 counter,
+                bulk=True,
             )
+            if counter % page_size == 0:
+                self.commit_published(rabbit)
+                logger.info("BULK update: %s datasets sent", counter)
+                if self.checkpoints is not None:
+                    self.checkpoints.set("bulk_update", dataset_url)
+            elif counter % self.publish_batch == 0:
+                self.commit_published(rabbit)
             counter += 1
+        self.commit_published(rabbit)
+        rabbit.close_connection()
+        if self.checkpoints is not None:
+            self.checkpoints.delete("bulk_update")
+            self.checkpoints.delete("bulk_update_watermark")
+            if watermark:
+                self.checkpoints.set("bulk_watermark", watermark)
+        logger.info("DONE bulk update: %s datasets", counter - 1)
+
+    def incremental_update(self):
+        """ Injects messages in rabbitmq only for the datasets modified since
+            the last bulk or incremental update. Falls back to a full bulk
+            update when there is no watermark yet.
+        """
+        if self.checkpoints is None:
+            raise RuntimeError("The incremental update needs a STATE_DB")
+        since = self.checkpoints.get("bulk_watermark")
+        if since is None:
+            logger.info("No watermark, running a full bulk update")
+            return self.bulk_update()
+
+        logger.info("START incremental update since %s", since)
+        watermark = self.new_watermark()
+        datasets = self.query_modified_datasets(since)
+        rabbit = self.get_rabbit()
+        self.start_publishing(rabbit)
+        for counter, (dataset_url, _modified) in enumerate(datasets, 1):
+            self.add_to_queue(
+                rabbit,
+                "update",
+                dataset_url,
+                "_fake_dataset_identifier_",
+                counter,
+                bulk=True,
+            )
+            if counter % self.publish_batch == 0:
+                self.commit_published(rabbit)
+        self.commit_published(rabbit)
         rabbit.close_connection()
-        logger.info("DONE bulk update")
+        self.checkpoints.set("bulk_watermark", watermark)
+        logger.info("DONE incremental update: %s datasets", len(datasets))
 
+    @metrics.timed("parse_dataset")
     def parse_dataset(self, dataset_rdf, dataset_url, check_obsolete=True):
         """
             refs: http://dataprotocols.org/data-packages/
         """
-        g = Graph().parse(data=dataset_rdf)
+        g = self.load_graph(dataset_rdf)
+        return self.parse_dataset_graph(g, dataset_url, check_obsolete)
+
+    def load_graph(self, dataset_rdf):
+        """ Load a RDF/XML response from SDS with the configured parser:
+            "rdflib" builds a full `Graph`, "index" a faster `RDFIndex`.
+        """
+        if self.parser == "index":
+            from rdfindex import RDFIndex
+
+            return RDFIndex(dataset_rdf)
+        from rdflib import Graph
+
+        return Graph().parse(data=dataset_rdf)
+
+    def parse_dataset_graph(self, g, dataset_url, check_obsolete=True):
+        """ Extract the dataset data from a graph returned by SDS, which
+            may hold other datasets too. `g` is a `Graph` or a `RDFIndex`.
+        """
+        from rdflib import URIRef
+        from rdflib.namespace import DCTERMS, RDF
+        from namespaces import (
+            DASHBOARD,
+            DAVIZ,
+            DCAT,
+            ECODP,
+            EEAFIGURE,
+            EU_DISTRIBUTION_TYPE,
+            EU_FILE_TYPE,
+            EU_STATUS,
+            EUROVOC,
+            GIS,
+            INFOGRAPHIC,
+            SCHEMA,
+        )
+
         dataset = URIRef(dataset_url)
 
         if check_obsolete and g.value(dataset, DCTERMS.isReplacedBy):
@@ -202,13 +576,17 @@ class SDSClient:
             name = FILE_TYPES.get(mime_type, "OCTET")
             return EU_FILE_TYPE[name]
 
-        keywords = [str(k) for k in g.objects(dataset, ECODP.keyword)]
-        geo_coverage = [str(k) for k in g.objects(dataset, DCTERMS.spatial)]
-        concepts_eurovoc = [
+        # SDS returns the values in no particular order, sort them so the
+        # same dataset is always rendered the same way
+        keywords = sorted(str(k) for k in g.objects(dataset, ECODP.keyword))
+        geo_coverage = sorted(
+            str(k) for k in g.objects(dataset, DCTERMS.spatial)
+        )
+        concepts_eurovoc = sorted(
             str(k)
             for k in g.objects(dataset, DCAT.theme)
             if str(k).startswith(str(EUROVOC))
-        ]
+        )
 
         resources = []
 
@@ -240,7 +618,7 @@ class SDSClient:
             resources.append(
                 {
                     "title": str(g.value(res, DCTERMS.title)),
-                    "filetype": file_type(list(file_types)[0]),
+                    "filetype": file_type(sorted(file_types)[0]),
                     "url": convert_directlink_to_view(
                         str(g.value(res, DCAT.accessURL))
                     ),
@@ -249,7 +627,9 @@ class SDSClient:
                 }
             )
 
-        for old in g.objects(dataset, DCTERMS.replaces):
+        resources.sort(key=lambda r: (r["url"], r["title"]))
+
+        for old in sorted(g.objects(dataset, DCTERMS.replaces)):
             issued = g.value(old, DCTERMS.issued).toPython().date()
             resources.append(
                 {
@@ -281,6 +661,32 @@ class SDSClient:
         dataset_rdf = self.query_dataset(dataset_url)
         return self.parse_dataset(dataset_rdf, dataset_url, check_obsolete)
 
+    def get_datasets(self, dataset_urls, check_obsolete=True, batch_size=None):
+        """ Query SDS for many datasets, `batch_size` datasets per query.
+            Returns a dict with the data of each dataset by URL; datasets
+            that are not found or fail to parse are logged and left out.
+        """
+        from rdflib import URIRef
+        from namespaces import SCHEMA
+
+        batch_size = batch_size or other_config["batch_size"]
+        dataset_urls = list(dataset_urls)
+        result = {}
+        for start in range(0, len(dataset_urls), batch_size):
+            chunk = dataset_urls[start:start + batch_size]
+            g = self.load_graph(self.query_datasets(chunk))
+            for dataset_url in chunk:
+                if g.value(URIRef(dataset_url), SCHEMA.productID) is None:
+                    logger.warning("Dataset %r not found in SDS", dataset_url)
+                    continue
+                try:
+                    result[dataset_url] = self.parse_dataset_graph(
+                        g, dataset_url, check_obsolete
+                    )
+                except Exception:
+                    logger.exception("ERROR parsing dataset %r", dataset_url)
+        return result
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="SDSClient")
@@ -290,14 +696,35 @@ if __name__ == "__main__":
         action="store_true",
         help="creates debug files for datasets queries",
     )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="always query SDS, even if SDS_CACHE is configured",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only send the datasets modified since the last bulk or "
+        "incremental update",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="start the bulk update from the beginning, even if the "
+        "previous one was interrupted",
+    )
     args = parser.parse_args()
 
+    from odpclient import ODPClient
+
     sds = SDSClient(
         services_config["sds"],
         other_config["timeout"],
         "odp_queue",
         ODPClient(),
     )
+    if args.no_cache:
+        sds.cache = None
 
     if args.debug:
         dataset_url = (
@@ -313,6 +740,9 @@ if __name__ == "__main__":
         )
         _rabbit.close_connection()
 
+    elif args.incremental:
+        sds.incremental_update()
+
     else:
         # initiate a bulk update operation
-        sds.bulk_update()
+        sds.bulk_update(restart=args.restart)
@@ -0,0 +1,129 @@
+""" SPARQL - query templates with typed, escaped parameters
+"""
+
+import functools
+import re
+from pathlib import Path
+
+QUERIES = Path(__file__).resolve().parent / "config"
+
+PLACEHOLDER = re.compile(r"%%|%\((\w+)\)s")
+IRI_SCHEME = re.compile(r"^[A-Za-z][A-Za-z0-9+.-]*:")
+# characters not allowed in a SPARQL IRIREF
+IRI_FORBIDDEN = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+
+# kind of parameter, from the text before and after its placeholder
+CONTEXTS = [
+    ("iri", re.compile(r"<$"), re.compile(r"^>")),
+    ("string", re.compile(r'"$'), re.compile(r'^"')),
+    ("iri_list", re.compile(r"\bIN\s*\(\s*$", re.I), re.compile(r"^\s*\)")),
+    (
+        "iri_values",
+        re.compile(r"\bVALUES\s+\?\w+\s*\{\s*$", re.I),
+        re.compile(r"^\s*\}"),
+    ),
+    ("integer", re.compile(r"\b(LIMIT|OFFSET)\s+$", re.I), re.compile("")),
+]
+
+
+def sparql_string(value):
+    """ Escape a value for use in a double quoted SPARQL string literal
+    """
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def sparql_iri(value):
+    """ Check that `value` is an absolute IRI and percent-encode the
+        characters that are not allowed between `<` and `>`.
+    """
+    value = str(value)
+    if not IRI_SCHEME.match(value):
+        raise ValueError("Not an absolute IRI: %r" % value)
+    return IRI_FORBIDDEN.sub(
+        lambda m: "".join("%%%02X" % b for b in m.group().encode("utf-8")),
+        value,
+    )
+
+
+def sparql_integer(value):
+    if isinstance(value, bool) or int(value) != value or value < 0:
+        raise ValueError("Not a positive integer: %r" % (value,))
+    return str(int(value))
+
+
+FORMATTERS = {
+    "iri": sparql_iri,
+    "string": sparql_string,
+    "iri_list": lambda values: ", ".join(
+        "<%s>" % sparql_iri(v) for v in values
+    ),
+    "iri_values": lambda values: " ".join(
+        "<%s>" % sparql_iri(v) for v in values
+    ),
+    "integer": sparql_integer,
+}
+
+
+class QueryTemplate:
+    """ A SPARQL query with `%(name)s` placeholders, and `%%` for `%`. The
+        text is split once into constant chunks and parameters; the kind of
+        each parameter comes from where it is used:
+
+        - `<%(name)s>`: an IRI
+        - `"%(name)s"`: a string
+        - `IN (%(name)s)` or `VALUES ?var { %(name)s }`: a list of IRIs
+        - `LIMIT %(name)s` or `OFFSET %(name)s`: an integer
+    """
+
+    def __init__(self, text, name="query"):
+        self.name = name
+        # constant strings and (parameter name, formatter) pairs
+        self.chunks = []
+        matches = list(PLACEHOLDER.finditer(text))
+        literal = []
+        pos = 0
+        for n, match in enumerate(matches):
+            literal.append(text[pos:match.start()])
+            pos = match.end()
+            if match.group() == "%%":
+                literal.append("%")
+                continue
+            before = "".join(literal)
+            end = matches[n + 1].start() if n + 1 < len(matches) else None
+            after = text[pos:end]
+            kind = self.get_kind(match.group(1), before, after)
+            self.chunks.append(before)
+            self.chunks.append((match.group(1), FORMATTERS[kind]))
+            literal = []
+        literal.append(text[pos:])
+        self.chunks.append("".join(literal))
+
+    def get_kind(self, param, before, after):
+        for kind, before_re, after_re in CONTEXTS:
+            if before_re.search(before) and after_re.search(after):
+                return kind
+        raise ValueError(
+            "Unsupported use of %%(%s)s in %s" % (param, self.name)
+        )
+
+    def render(self, **params):
+        """ The query text, with the parameters formatted and escaped
+        """
+        return "".join(
+            chunk if isinstance(chunk, str) else chunk[1](params[chunk[0]])
+            for chunk in self.chunks
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_query(name):
+    """ The template in "config/<name>.sparql", read and parsed once
+    """
+    text = (QUERIES / (name + ".sparql")).read_text("utf-8")
+    return QueryTemplate(text, name)
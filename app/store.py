@@ -0,0 +1,352 @@
+""" Store - small SQLite tables that keep state between runs
+"""
+
+import json
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class SQLiteStore:
+    """ Base class for a SQLite backed store. Subclasses define `schema`.
+        The connection is shared between threads, access is serialized.
+    """
+
+    schema = ""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript(self.schema)
+
+    def execute(self, sql, params=()):
+        with self.lock, self.conn:
+            return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+class FingerprintStore(SQLiteStore):
+    """ Fingerprint of the last dataset published to ODP, by product_id
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS fingerprint (
+            product_id TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+    """
+
+    def get(self, product_id):
+        rows = self.execute(
+            "SELECT fingerprint FROM fingerprint WHERE product_id = ?",
+            (product_id,),
+        )
+        return rows[0][0] if rows else None
+
+    def set(self, product_id, fingerprint):
+        self.execute(
+            "INSERT OR REPLACE INTO fingerprint VALUES (?, ?, ?)",
+            (product_id, fingerprint, time.time()),
+        )
+
+
+class LatestVersionStore(SQLiteStore):
+    """ Latest published version of the replaced datasets
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS latest_version (
+            dataset TEXT PRIMARY KEY,
+            latest TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+    """
+
+    def load(self):
+        """ Returns the stored mapping and when it was saved, or
+            `(None, None)` if nothing was saved yet.
+        """
+        rows = self.execute(
+            "SELECT dataset, latest, updated FROM latest_version"
+        )
+        if not rows:
+            return None, None
+        return {r[0]: r[1] for r in rows}, min(r[2] for r in rows)
+
+    def save(self, mapping):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM latest_version")
+            self.conn.executemany(
+                "INSERT INTO latest_version VALUES (?, ?, ?)",
+                [(k, v, now) for k, v in mapping.items()],
+            )
+
+
+class ConceptStore(SQLiteStore):
+    """ Eurovoc concepts of the packages published in ODP, by product_id
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS concept (
+            product_id TEXT PRIMARY KEY,
+            concepts TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+    """
+
+    def get(self, product_id):
+        rows = self.execute(
+            "SELECT concepts FROM concept WHERE product_id = ?", (product_id,)
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    def set(self, product_id, concepts):
+        self.execute(
+            "INSERT OR REPLACE INTO concept VALUES (?, ?, ?)",
+            (product_id, json.dumps(concepts), time.time()),
+        )
+
+    def refreshed(self):
+        """ When all the concepts were last saved, or None.
+        """
+        return self.execute("SELECT MIN(updated) FROM concept")[0][0]
+
+    def save(self, mapping):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM concept")
+            self.conn.executemany(
+                "INSERT INTO concept VALUES (?, ?, ?)",
+                [(k, json.dumps(v), now) for k, v in mapping.items()],
+            )
+
+
+class RedirectCache(SQLiteStore):
+    """ Where each URL redirects to, or None if it does not redirect
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS redirect (
+            url TEXT PRIMARY KEY,
+            location TEXT,
+            updated REAL NOT NULL
+        );
+    """
+
+    def get(self, url):
+        """ Returns `(found, location)`.
+        """
+        rows = self.execute(
+            "SELECT location FROM redirect WHERE url = ?", (url,)
+        )
+        return (True, rows[0][0]) if rows else (False, None)
+
+    def set(self, url, location):
+        self.execute(
+            "INSERT OR REPLACE INTO redirect VALUES (?, ?, ?)",
+            (url, location, time.time()),
+        )
+
+
+class MirrorStore(SQLiteStore):
+    """ Local copy of packages, by id, with the version they were saved at
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS package (
+            id TEXT PRIMARY KEY,
+            version TEXT NOT NULL,
+            package TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+    """
+
+    def versions(self):
+        return dict(self.execute("SELECT id, version FROM package"))
+
+    def get(self, id):
+        rows = self.execute("SELECT package FROM package WHERE id = ?", (id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def save(self, packages):
+        """ Save a list of `(id, version, package)`.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO package VALUES (?, ?, ?, ?)",
+                [(i, v, json.dumps(p), now) for i, v, p in packages],
+            )
+
+    def delete(self, ids):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM package WHERE id = ?", [(i,) for i in ids]
+            )
+
+    def iter_packages(self, page_size=500):
+        """ The packages ordered by id, read `page_size` at a time.
+        """
+        last = ""
+        while True:
+            rows = self.execute(
+                "SELECT id, package FROM package WHERE id > ? "
+                "ORDER BY id LIMIT ?",
+                (last, page_size),
+            )
+            for last, package in rows:
+                yield json.loads(package)
+            if len(rows) < page_size:
+                return
+
+
+class JournalStore(SQLiteStore):
+    """ Outcome of each item of a batch operation, by operation and key.
+        `error` is None for the items that succeeded.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS journal (
+            operation TEXT NOT NULL,
+            key TEXT NOT NULL,
+            error TEXT,
+            updated REAL NOT NULL,
+            PRIMARY KEY (operation, key)
+        );
+    """
+
+    def done(self, operation):
+        rows = self.execute(
+            "SELECT key FROM journal WHERE operation = ? AND error IS NULL",
+            (operation,),
+        )
+        return {r[0] for r in rows}
+
+    def failed(self, operation):
+        """ Returns `{key: error}` of the items that failed.
+        """
+        rows = self.execute(
+            "SELECT key, error FROM journal "
+            "WHERE operation = ? AND error IS NOT NULL",
+            (operation,),
+        )
+        return dict(rows)
+
+    def set(self, operation, key, error=None):
+        self.execute(
+            "INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?)",
+            (operation, key, error, time.time()),
+        )
+
+    def clear(self, operation):
+        self.execute("DELETE FROM journal WHERE operation = ?", (operation,))
+
+
+class CheckpointStore(SQLiteStore):
+    """ Named progress markers of the long running operations
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS checkpoint (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+    """
+
+    def get(self, name):
+        rows = self.execute(
+            "SELECT value FROM checkpoint WHERE name = ?", (name,)
+        )
+        return rows[0][0] if rows else None
+
+    def set(self, name, value):
+        self.execute(
+            "INSERT OR REPLACE INTO checkpoint VALUES (?, ?, ?)",
+            (name, value, time.time()),
+        )
+
+    def delete(self, name):
+        self.execute("DELETE FROM checkpoint WHERE name = ?", (name,))
+
+
+class ResponseCache(SQLiteStore):
+    """ Compressed HTTP responses by key, evicted by least recent use when
+        their total size goes over `max_size` bytes
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS response (
+            key TEXT PRIMARY KEY,
+            body BLOB NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed);
+    """
+
+    def __init__(self, path, max_size):
+        super().__init__(path)
+        self.max_size = max_size
+
+    def get(self, key):
+        """ Returns `(text, etag, last_modified, created)` or None.
+        """
+        rows = self.execute(
+            "SELECT body, etag, last_modified, created FROM response "
+            "WHERE key = ?",
+            (key,),
+        )
+        if not rows:
+            return None
+        self.execute(
+            "UPDATE response SET accessed = ? WHERE key = ?",
+            (time.time(), key),
+        )
+        body, etag, last_modified, created = rows[0]
+        text = zlib.decompress(body).decode("utf-8")
+        return text, etag, last_modified, created
+
+    def set(self, key, text, etag=None, last_modified=None):
+        body = zlib.compress(text.encode("utf-8"))
+        now = time.time()
+        self.execute(
+            "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, body, etag, last_modified, len(body), now, now),
+        )
+        self.evict()
+
+    def refresh(self, key):
+        """ Mark a response as fresh again, after it was revalidated.
+        """
+        now = time.time()
+        self.execute(
+            "UPDATE response SET created = ?, accessed = ? WHERE key = ?",
+            (now, now, key),
+        )
+
+    def evict(self):
+        with self.lock, self.conn:
+            total = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM response"
+            ).fetchone()[0]
+            if total <= self.max_size:
+                return
+            rows = self.conn.execute(
+                "SELECT key, size FROM response ORDER BY accessed"
+            ).fetchall()
+            for key, size in rows:
+                if total <= self.max_size:
+                    break
+                self.conn.execute("DELETE FROM response WHERE key = ?", (key,))
+                total -= size
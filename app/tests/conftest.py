@@ -2,13 +2,25 @@ from pathlib import Path
 from contextlib import contextmanager
 import os
 
+import pytest
+
 import sdsclient
+from backpressure import breakers
 
 sds_responses = Path(__file__).resolve().parent / "sds_responses"
 
 SDS_MOCK_SPY = os.environ.get("SDS_MOCK_SPY")
 
 
+@pytest.fixture(autouse=True)
+def reset_breakers():
+    """ Close the circuit breakers opened by a test.
+    """
+    yield
+    for breaker in breakers.values():
+        breaker.reset()
+
+
 @contextmanager
 def mock_sds(mocker, filename):
     """ Mock the SDS service.
@@ -0,0 +1,214 @@
+import pytest
+
+import ckanclient
+from backpressure import (
+    AdaptiveLimit,
+    CircuitBreaker,
+    CircuitOpenError,
+    breakers,
+)
+
+from .test_queue import fake_queues, queue_messages
+
+
+def fake_clock(mocker, on_sleep=None):
+    """ Patch `time.monotonic` and `time.sleep` with a clock that only
+        moves when sleeping. Returns the `sleep` mock.
+    """
+    now = mocker.patch("time.monotonic", return_value=1000.0)
+
+    def sleep(seconds):
+        now.return_value += seconds
+        if on_sleep is not None:
+            on_sleep()
+
+    return mocker.patch("time.sleep", side_effect=sleep)
+
+
+def test_circuit_breaker_opens_and_recovers(mocker):
+    now = mocker.patch("time.monotonic", return_value=100.0)
+    breaker = CircuitBreaker("sds", failure_threshold=2, reset_timeout=30)
+    func = mocker.Mock(side_effect=ConnectionError)
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            breaker.call(func)
+    with pytest.raises(CircuitOpenError):
+        breaker.call(func)
+    assert func.call_count == 2
+    assert breaker.wait_time() == 30
+
+    # one call is let through after `reset_timeout`, it fails again
+    now.return_value = 130.0
+    assert breaker.wait_time() == 0
+    with pytest.raises(ConnectionError):
+        breaker.call(func)
+    assert func.call_count == 3
+    assert breaker.wait_time() == 30
+
+    now.return_value = 160.0
+    func.side_effect = None
+    func.return_value = "ok"
+    assert breaker.call(func) == "ok"
+    assert breaker.wait_time() == 0
+    assert breaker.call(func) == "ok"
+
+
+def test_circuit_breaker_ignores_request_errors(mocker):
+    breaker = CircuitBreaker("odp", failure_threshold=1)
+
+    @breaker.protect(ignore=(ValueError,))
+    def package_save():
+        raise ValueError("invalid package")
+
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            package_save()
+    assert breaker.wait_time() == 0
+
+
+def test_adaptive_limit():
+    limit = AdaptiveLimit(8, latency_target=10)
+    limit.record(1, False)
+    assert limit.value == 4
+    limit.record(20, True)
+    assert limit.value == 2
+    for _ in range(4):
+        limit.record(20, False)
+    assert limit.value == 1
+
+    calls = 0
+    while limit.value < 8:
+        limit.record(1, True)
+        calls += 1
+    assert calls == 1 + 2 + 3 + 4 + 5 + 6 + 7
+    limit.record(1, True)
+    assert limit.value == 8
+
+
+def test_only_upstream_failures_lower_the_limit(mocker):
+    cc = ckanclient.CKANClient("odp_queue", workers=8)
+    body = "update|http://www.eea.europa.eu/data-and-maps/data/dataset|_x"
+    publish_dataset = mocker.patch.object(cc, "publish_dataset")
+    publish_dataset.side_effect = ValueError("Dataset is obsolete")
+
+    for _ in range(3):
+        assert cc.message_callback("invalid_message") is False
+        assert cc.message_callback(body) is False
+    assert cc.limiter.value == 8
+    assert cc.in_flight_limit() == 16
+
+    publish_dataset.side_effect = lambda u: breakers["sds"].call(
+        mocker.Mock(side_effect=ConnectionError)
+    )
+    assert cc.message_callback(body) is False
+    assert cc.limiter.value == 4
+
+
+def test_pause_while_upstream_is_unavailable(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    rabbit = mocker.patch.object(cc, "rabbit")
+    channel = rabbit.get_channel.return_value
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    bodies = ["update|" + url % n + "|_ignored" for n in range(4)]
+    queue = queue_messages(mocker, bodies)
+    rabbit.get_message.side_effect = fake_queues({"odp_queue": queue})
+
+    def requeue(delivery_tag, requeue):
+        # redelivered first, with a new delivery tag
+        body = bodies[delivery_tag - 1]
+        queue[:0] = queue_messages(mocker, [body], start=10 + delivery_tag)
+
+    channel.basic_nack.side_effect = requeue
+    sds = breakers["sds"]
+    mocker.patch.object(sds, "failure_threshold", 1)
+    mocker.patch.object(sds, "reset_timeout", 30)
+
+    down = [True]
+
+    def publish_dataset(dataset_url):
+        if down:
+            # the first message finds SDS down, it is back after the pause
+            down.pop()
+            sds.call(mocker.Mock(side_effect=ConnectionError))
+        sds.call(lambda: None)
+
+    mocker.patch.object(cc, "publish_dataset", side_effect=publish_dataset)
+    sleep = fake_clock(mocker)
+
+    cc.start_consuming_ex()
+
+    sleep.assert_called_once()
+    assert 0 < sleep.call_args[0][0] <= 30
+    # the message that failed and the one fetched ahead of the pause
+    nacked = {c[1]["delivery_tag"] for c in channel.basic_nack.call_args_list}
+    assert nacked == {1, 2}
+    published = [c[0][0] for c in cc.publish_dataset.call_args_list]
+    assert sorted(published) == [url % n for n in [0, 0, 1, 1, 2, 3]]
+    acked = {c[1]["delivery_tag"] for c in channel.basic_ack.call_args_list}
+    assert acked == {3, 4, 11, 12}
+
+
+def test_retry_the_last_message_after_an_outage(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    rabbit = mocker.patch.object(cc, "rabbit")
+    channel = rabbit.get_channel.return_value
+    body = "update|http://www.eea.europa.eu/data-and-maps/data/dataset|_x"
+    queue = queue_messages(mocker, [body])
+    rabbit.get_message.side_effect = fake_queues({"odp_queue": queue})
+
+    def requeue(delivery_tag, requeue):
+        queue.extend(queue_messages(mocker, [body], start=2))
+
+    channel.basic_nack.side_effect = requeue
+    sds = breakers["sds"]
+    mocker.patch.object(sds, "failure_threshold", 1)
+    down = [True]
+
+    def publish_dataset(dataset_url):
+        if down:
+            # SDS fails on the last message of the queue
+            down.pop()
+            sds.call(mocker.Mock(side_effect=ConnectionError))
+        sds.call(lambda: None)
+
+    mocker.patch.object(cc, "publish_dataset", side_effect=publish_dataset)
+    sleep = fake_clock(mocker)
+
+    cc.start_consuming_ex()
+
+    assert cc.publish_dataset.call_count == 2
+    sleep.assert_called_once_with(sds.reset_timeout)
+    channel.basic_nack.assert_called_once_with(delivery_tag=1, requeue=True)
+    channel.basic_ack.assert_called_once_with(delivery_tag=2)
+
+
+def test_stop_when_upstream_stays_unavailable(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.max_pause = 60
+    rabbit = mocker.patch.object(cc, "rabbit")
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    bodies = ["update|" + url % n + "|_ignored" for n in range(3)]
+    rabbit.get_message.side_effect = fake_queues(
+        {"odp_queue": queue_messages(mocker, bodies)}
+    )
+    channel = rabbit.get_channel.return_value
+    sleep = fake_clock(mocker)
+    odp = breakers["odp"]
+    mocker.patch.object(odp, "reset_timeout", 30)
+    for _ in range(odp.failure_threshold):
+        odp.record_failure()
+    # every call let through fails again
+    publish_dataset = mocker.patch.object(cc, "publish_dataset")
+    publish_dataset.side_effect = lambda u: odp.call(
+        mocker.Mock(side_effect=ConnectionError)
+    )
+
+    cc.start_consuming_ex()
+
+    assert [c[0][0] for c in sleep.call_args_list] == [30, 30]
+    # two messages are fetched after the first pause, one after the second
+    assert publish_dataset.call_count == 3
+    assert channel.basic_nack.call_count == 3
+    channel.basic_ack.assert_not_called()
+    rabbit.close_connection.assert_called_once_with()
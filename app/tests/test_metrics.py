@@ -0,0 +1,53 @@
+import ckanclient
+from metrics import Metrics
+
+from .test_queue import fake_queues, queue_messages
+
+
+def test_render_prometheus_format():
+    m = Metrics()
+    m.inc("messages_processed")
+    m.inc("messages_processed", 2)
+    m.observe("sds_query", 0.2)
+    with m.timer("sds_query"):
+        pass
+
+    text = m.render()
+
+    bucket = 'odpckan_stage_seconds_bucket{stage="sds_query",le="%s"} %s\n'
+    assert "odpckan_messages_processed_total 3\n" in text
+    assert bucket % (0.1, 1) in text
+    assert bucket % (0.25, 2) in text
+    assert 'odpckan_stage_seconds_count{stage="sds_query"} 2\n' in text
+
+
+def test_write_metrics_file(tmp_path):
+    m = Metrics()
+    m.inc("messages_failed")
+    m.write(str(tmp_path / "odpckan.prom"))
+
+    assert (tmp_path / "odpckan.prom").read_text() == m.render()
+    assert [p.name for p in tmp_path.iterdir()] == ["odpckan.prom"]
+
+
+def test_count_consumed_messages(mocker):
+    m = mocker.patch.object(ckanclient, "metrics", Metrics())
+    cc = ckanclient.CKANClient("odp_queue")
+    rabbit = mocker.patch.object(cc, "rabbit")
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    bodies = ["update|" + url % n + "|_ignored" for n in range(4)]
+    bodies += [bodies[0], "invalid_message"]
+    rabbit.get_message.side_effect = fake_queues(
+        {"odp_queue": queue_messages(mocker, bodies)}
+    )
+    publish_dataset = mocker.patch.object(cc, "publish_dataset")
+    publish_dataset.side_effect = lambda u: not u.endswith("dataset-3")
+
+    cc.start_consuming_ex()
+
+    assert m.counters == {
+        "messages_processed": 4,
+        "messages_skipped": 1,
+        "messages_failed": 1,
+        "messages_duplicate": 1,
+    }
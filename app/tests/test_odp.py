@@ -1,7 +1,15 @@
+import json
+import threading
+import time
+
+import pytest
 from rdflib import Graph, Literal, URIRef
 from rdflib.namespace import DCTERMS, XSD, FOAF, RDF
 
 import ckanclient
+from odpclient import ODPClient
+from renderer import DirectRenderer, TemplateRenderer
+from store import ConceptStore, FingerprintStore
 from sdsclient import (
     DCAT,
     VCARD,
@@ -15,7 +23,7 @@ from sdsclient import (
     EUROVOC,
 )
 
-from .conftest import mock_sds
+from .conftest import mock_sds, sds_responses
 
 
 def dataset_to_graph(mocker, product_id, dataset_url):
@@ -263,3 +271,170 @@ def test_preserve_odp_eurovoc_concepts(mocker):
     assert set(g.objects(dataset, DCTERMS.subject)) == {
         EUROVOC[c] for c in ["5650", "434843", "6011", "1352"]
     }
+
+
+def test_skip_unchanged_dataset(mocker, tmp_path):
+    product_id = "DAT-21-en"
+    dataset_url = (
+        "http://www.eea.europa.eu/data-and-maps/data/"
+        "european-union-emissions-trading-scheme-13"
+    )
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.fingerprints = FingerprintStore(tmp_path / "state.db")
+
+    mocker.patch.object(cc.odp, "package_show").return_value = None
+    mocker.patch.object(cc.sds, "get_latest_version").side_effect = lambda d: d
+
+    package_save = mocker.patch.object(cc.odp, "package_save")
+    with mock_sds(mocker, product_id + ".rdf"):
+        assert cc.publish_dataset(dataset_url)
+        assert not cc.publish_dataset(dataset_url)
+        assert package_save.call_count == 1
+
+        cc.force = True
+        assert cc.publish_dataset(dataset_url)
+        assert package_save.call_count == 2
+
+
+def test_deterministic_uuids(mocker):
+    product_id = "DAT-21-en"
+    dataset_url = (
+        "http://www.eea.europa.eu/data-and-maps/data/"
+        "european-union-emissions-trading-scheme-13"
+    )
+    cc = ckanclient.CKANClient("odp_queue", deterministic_uuids=True)
+
+    mocker.patch.object(cc.odp, "package_show").return_value = None
+    mocker.patch.object(cc.sds, "get_latest_version").side_effect = lambda d: d
+
+    package_save = mocker.patch.object(cc.odp, "package_save")
+    with mock_sds(mocker, product_id + ".rdf"):
+        cc.publish_dataset(dataset_url)
+        cc.publish_dataset(dataset_url)
+
+    first, second = [c[0][1] for c in package_save.call_args_list]
+    assert first == second
+
+    g = Graph().parse(data=first)
+    dataset = URIRef("http://data.europa.eu/88u/dataset/" + product_id)
+    assert len(set(g.objects(dataset, DCAT.distribution))) == 29
+
+
+def test_eurovoc_concepts_from_the_concept_store(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.concepts_ttl = 3600
+    cc.concepts = ConceptStore(":memory:")
+    package_search = mocker.patch.object(cc.odp, "package_search")
+    package_search.return_value = [
+        {
+            "dataset": {
+                "uri": "http://data.europa.eu/88u/dataset/DAT-21-en",
+                "subject_dcterms": [{"uri": "http://eurovoc.europa.eu/1352"}],
+            },
+        },
+    ]
+    package_show = mocker.patch.object(cc.odp, "package_show")
+    package_show.return_value = None
+
+    assert cc.get_odp_eurovoc_concepts("DAT-21-en") == [
+        "http://eurovoc.europa.eu/1352"
+    ]
+    assert cc.get_odp_eurovoc_concepts("DAT-22-en") == []
+    assert cc.get_odp_eurovoc_concepts("DAT-22-en") == []
+    package_search.assert_called_once_with(fq="organization:eea")
+    package_show.assert_called_once_with("DAT-22-en")
+
+    cc.concepts_refreshed -= 3601
+    cc.get_odp_eurovoc_concepts("DAT-21-en")
+    assert package_search.call_count == 2
+
+
+def test_eurovoc_concepts_are_served_while_loading(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.concepts_ttl = 3600
+    cc.concepts = ConceptStore(":memory:")
+    cc.concepts.save({"DAT-21-en": ["http://eurovoc.europa.eu/1"]})
+    cc.concepts_refreshed = time.time() - 3601
+    package_show = mocker.patch.object(cc.odp, "package_show")
+    searching = threading.Event()
+    loaded = threading.Event()
+
+    def package_search(fq):
+        searching.set()
+        loaded.wait(5)
+        uri = "http://data.europa.eu/88u/dataset/DAT-21-en"
+        subjects = [{"uri": "http://eurovoc.europa.eu/2"}]
+        return [{"dataset": {"uri": uri, "subject_dcterms": subjects}}]
+
+    search = mocker.patch.object(cc.odp, "package_search")
+    search.side_effect = package_search
+    loading = threading.Thread(
+        target=cc.get_odp_eurovoc_concepts, args=("DAT-21-en",)
+    )
+    loading.start()
+    assert searching.wait(5)
+    # the old concepts, without waiting for the search
+    assert cc.get_odp_eurovoc_concepts("DAT-21-en") == [
+        "http://eurovoc.europa.eu/1"
+    ]
+    loaded.set()
+    loading.join(5)
+    assert cc.get_odp_eurovoc_concepts("DAT-21-en") == [
+        "http://eurovoc.europa.eu/2"
+    ]
+    assert search.call_count == 1
+    package_show.assert_not_called()
+
+    # after a failure, the search is not tried again for a while
+    cc.concepts_refreshed -= 3601
+    search.side_effect = ConnectionError
+    for _ in range(2):
+        assert cc.get_odp_eurovoc_concepts("DAT-21-en") == [
+            "http://eurovoc.europa.eu/2"
+        ]
+    assert search.call_count == 2
+    cc.concepts_retry = 0
+    cc.get_odp_eurovoc_concepts("DAT-21-en")
+    assert search.call_count == 3
+
+
+def test_package_search_pages(mocker):
+    odp = ODPClient()
+    packages = [{"id": n} for n in range(25)]
+
+    def package_search(fq, output_format, start, rows):
+        # the page size is capped by ODP
+        return {"count": len(packages), "results": packages[start:start + 3]}
+
+    search = mocker.patch.object(odp.conn, "action").package_search
+    search.side_effect = package_search
+
+    assert list(odp.package_search("organization:eea", 5, 2)) == packages
+    starts = sorted(c[1]["start"] for c in search.call_args_list)
+    assert starts == list(range(0, 25, 3))
+
+
+@pytest.mark.parametrize(
+    "product_id, dataset_url",
+    [
+        ("DAT-21-en", "european-union-emissions-trading-scheme-13"),
+        ("DAT-137-en", "eunis-habitat-classification"),
+        ("DAT-150-en", "air-pollutant-concentrations-at-station"),
+        ("DAT-176-en", "fuel-quality-directive-1"),
+    ],
+)
+def test_direct_renderer(tmp_path, product_id, dataset_url):
+    cc = ckanclient.CKANClient("odp_queue", deterministic_uuids=True)
+    dataset_url = "http://www.eea.europa.eu/data-and-maps/data/" + dataset_url
+    rdf = (sds_responses / (product_id + ".rdf")).read_text("utf-8")
+    data = cc.sds.parse_dataset(rdf, dataset_url)
+    data["uri"] = cc.get_ckan_uri(data["product_id"])
+    data["title"] += ' <"&">'
+    frozen = json.dumps(data, sort_keys=True)
+
+    cc.renderer = TemplateRenderer(cache_dir=str(tmp_path))
+    expected = cc.render_ckan_rdf(data)
+    assert list(tmp_path.iterdir())
+    assert json.dumps(data, sort_keys=True) == frozen
+    cc.renderer = DirectRenderer()
+    assert cc.render_ckan_rdf(data) == expected
@@ -1,4 +1,7 @@
+import time
+
 import ckanclient
+from config import other_config
 
 
 def test_queue_message_handler(mocker):
@@ -23,3 +26,351 @@ def test_queue_message_handler(mocker):
 
     success_3 = cc.message_callback("invalid_message")
     assert not success_3
+
+
+def queue_messages(mocker, bodies, start=1):
+    """ Build `get_message` results for the given bodies.
+    """
+    messages = []
+    for n, body in enumerate(bodies, start):
+        method = mocker.Mock(delivery_tag=n)
+        properties = mocker.Mock(content_encoding="utf-8", headers=None)
+        messages.append((method, properties, body.encode("utf-8")))
+    return messages
+
+
+def fake_queues(queues):
+    """ A `get_message` side effect, returning the messages of each queue
+        and then the empty queue marker.
+    """
+
+    def get_message(queue_name):
+        if queues.get(queue_name):
+            return queues[queue_name].pop(0)
+        return None, None, None
+
+    return get_message
+
+
+def test_consume_concurrently(mocker):
+    cc = ckanclient.CKANClient("odp_queue", workers=4)
+    rabbit = mocker.patch.object(cc, "rabbit")
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    bodies = ["update|" + url % n + "|_ignored" for n in range(10)]
+    bodies += [bodies[0], bodies[3], "update|" + url % "failed" + "|_ignored"]
+    rabbit.get_message.side_effect = fake_queues(
+        {"odp_queue": queue_messages(mocker, bodies)}
+    )
+    publish_dataset = mocker.patch.object(cc, "publish_dataset")
+    publish_dataset.side_effect = lambda u: u.endswith("failed") and 1 / 0
+
+    cc.start_consuming_ex()
+
+    published = sorted(c[0][0] for c in publish_dataset.call_args_list)
+    assert published == sorted([url % n for n in range(10)] + [url % "failed"])
+    channel = rabbit.get_channel.return_value
+    calls = channel.basic_ack.call_args_list
+    acked = sorted(c[1]["delivery_tag"] for c in calls)
+    # the failed message is acknowledged once moved to the retry queue
+    assert acked == list(range(1, 14))
+    assert retried(channel) == [("odp_queue_retry", bodies[-1], 1)]
+    rabbit.close_connection.assert_called_once_with()
+
+
+class FakeConnection:
+    """ Delivers the messages to the consumer, at most `prefetch` not
+        acknowledged at a time, and runs the callbacks scheduled by the
+        workers, like `BlockingConnection`. Stops the client once
+        `delivered` messages are acknowledged or delayed, or after
+        `max_rounds` rounds.
+    """
+
+    max_rounds = 200
+
+    def __init__(self, cc, channel, messages, prefetch=None):
+        self.cc = cc
+        self.channel = channel
+        self.messages = messages
+        self.prefetch = prefetch or len(messages)
+        self.sent = []
+        self.rounds = 0
+        self.callbacks = []
+        self.timeouts = []
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append(callback)
+
+    def unacked(self):
+        calls = (
+            self.channel.basic_ack.call_args_list
+            + self.channel.basic_nack.call_args_list
+        )
+        done = {c[1]["delivery_tag"] for c in calls}
+        return [tag for tag in self.sent if tag not in done]
+
+    def process_data_events(self, time_limit=0):
+        on_message = self.channel.basic_consume.call_args[0][0]
+        while self.messages and len(self.unacked()) < self.prefetch:
+            message = self.messages.pop(0)
+            self.sent.append(message[0].delivery_tag)
+            on_message(self.channel, *message)
+        time.sleep(0.01)
+        while self.callbacks:
+            self.callbacks.pop(0)()
+        acked = self.channel.basic_ack.call_count + len(self.timeouts)
+        self.rounds += 1
+        if acked == self.delivered or self.rounds >= self.max_rounds:
+            self.cc.stop()
+
+
+def retried(channel):
+    """ `(queue, body, retries)` of the messages sent to retry queues
+    """
+    return [
+        (
+            c[1]["routing_key"],
+            c[1]["body"].decode("utf-8"),
+            c[1]["properties"].headers["retries"],
+        )
+        for c in channel.basic_publish.call_args_list
+    ]
+
+
+def test_consume_as_daemon(mocker):
+    cc = ckanclient.CKANClient("odp_queue", workers=4)
+    rabbit = mocker.patch.object(cc, "rabbit")
+    channel = rabbit.get_channel.return_value
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    bodies = ["update|" + url % n + "|_ignored" for n in range(6)]
+    bodies += [bodies[0], "invalid_message"]
+    messages = queue_messages(mocker, bodies)
+    connection = channel.connection = FakeConnection(cc, channel, messages)
+    connection.delivered = len(messages)
+    channel.basic_get.return_value = (None, None, None)
+    mocker.patch("signal.signal")
+    publish_dataset = mocker.patch.object(cc, "publish_dataset")
+    publish_dataset.side_effect = lambda u: time.sleep(0.05)
+
+    cc.start_consuming_daemon()
+
+    assert publish_dataset.call_count == 6
+    acked = {c[1]["delivery_tag"] for c in channel.basic_ack.call_args_list}
+    assert acked == set(range(1, 9))
+    assert retried(channel) == [("odp_queue_retry", "invalid_message", 1)]
+    assert channel.basic_publish.call_args[1]["properties"].expiration == (
+        str(cc.retry_delay * 1000)
+    )
+    channel.basic_nack.assert_not_called()
+    channel.queue_declare.assert_any_call(
+        queue="odp_queue_retry",
+        durable=True,
+        arguments={
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": "odp_queue",
+        },
+    )
+    channel.basic_qos.assert_called_once_with(prefetch_count=cc.prefetch)
+    rabbit.close_connection.assert_called_once_with()
+
+
+def test_failing_messages_do_not_hold_the_prefetch_window(mocker):
+    cc = ckanclient.CKANClient("odp_queue", workers=1, prefetch=2)
+    rabbit = mocker.patch.object(cc, "rabbit")
+    channel = rabbit.get_channel.return_value
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    bodies = ["update|" + url % n + "|_ignored" for n in range(3)]
+    messages = queue_messages(mocker, bodies)
+    # the first message was already retried once
+    messages[0][1].headers = {"retries": 1}
+    connection = FakeConnection(cc, channel, messages, prefetch=cc.prefetch)
+    channel.connection = connection
+    connection.delivered = len(messages)
+    channel.basic_get.return_value = (None, None, None)
+    mocker.patch("signal.signal")
+    publish_dataset = mocker.patch.object(cc, "publish_dataset")
+    publish_dataset.side_effect = lambda u: u != url % 2 and 1 / 0
+
+    cc.start_consuming_daemon()
+
+    assert connection.rounds < connection.max_rounds
+    assert publish_dataset.call_args_list[-1] == mocker.call(url % 2)
+    assert retried(channel) == [
+        ("odp_queue_retry", bodies[0], 2),
+        ("odp_queue_retry", bodies[1], 1),
+    ]
+
+
+def test_park_messages_after_max_retries(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.max_retries = 3
+    rabbit = mocker.patch.object(cc, "rabbit")
+    channel = rabbit.get_channel.return_value
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    bodies = ["update|" + url % n + "|_ignored" for n in range(2)]
+    messages = queue_messages(mocker, bodies)
+    messages[0][1].headers = {"retries": 3}
+    messages[1][1].headers = {"retries": 2}
+    connection = channel.connection = FakeConnection(cc, channel, messages)
+    connection.delivered = len(messages)
+    channel.basic_get.return_value = (None, None, None)
+    mocker.patch("signal.signal")
+    mocker.patch.object(cc, "publish_dataset", side_effect=ZeroDivisionError)
+
+    cc.start_consuming_daemon()
+
+    assert retried(channel) == [
+        ("odp_queue_failed", bodies[0], 4),
+        ("odp_queue_retry", bodies[1], 3),
+    ]
+    parked = channel.basic_publish.call_args_list[0][1]["properties"]
+    assert parked.expiration is None
+    channel.queue_declare.assert_any_call(
+        queue="odp_queue_failed", durable=True
+    )
+
+
+def test_consume_priority_queue_first(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    rabbit = mocker.patch.object(cc, "rabbit")
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    bulk = ["update|" + url % n + "|_ignored" for n in range(3)]
+    cms = ["update|" + url % n + "|_ignored" for n in range(10, 12)]
+    queues = {
+        "odp_queue_bulk": queue_messages(mocker, bulk),
+        "odp_queue": queue_messages(mocker, cms, start=4),
+    }
+    get_message = fake_queues(queues)
+
+    def get_message_with_new_cms_message(queue_name):
+        # a CMS message arrives while the bulk queue is being processed
+        if queue_name == "odp_queue_bulk" and len(queues[queue_name]) == 2:
+            queues["odp_queue"] += queue_messages(mocker, cms[:1], start=9)
+        return get_message(queue_name)
+
+    rabbit.get_message.side_effect = get_message_with_new_cms_message
+    publish_dataset = mocker.patch.object(cc, "publish_dataset")
+
+    cc.start_consuming_ex()
+
+    published = [c[0][0] for c in publish_dataset.call_args_list]
+    assert published == [
+        url % 10,
+        url % 11,
+        url % 0,
+        url % 1,
+        url % 2,
+    ]
+
+
+def test_load_the_version_index_before_consuming(mocker):
+    mocker.patch.dict(other_config, {"version_index_ttl": 3600})
+    cc = ckanclient.CKANClient("odp_queue")
+    calls = mocker.Mock()
+    cc.rabbit = calls.rabbit
+    cc.rabbit.get_message.return_value = (None, None, None)
+    mocker.patch.object(cc.sds, "get_version_index", calls.get_version_index)
+
+    cc.start_consuming_ex()
+
+    assert calls.mock_calls[:2] == [
+        mocker.call.get_version_index(wait=True),
+        mocker.call.rabbit.open_connection(),
+    ]
+
+
+def test_coalesce_messages_with_the_same_target(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    rabbit = mocker.patch.object(cc, "rabbit")
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    cc.sds.version_index_ttl = 3600
+    mocker.patch.object(cc.sds, "get_version_index").return_value = {
+        url % "1": url % "3",
+        url % "2": url % "3",
+    }
+    bodies = [
+        "update|" + url % "0" + "|_ignored",
+        "create|" + url % "0" + "/|_ignored",
+        "update|" + (url % "0").replace("http", "https") + "|_ignored",
+        "update|" + url % "1" + "|_ignored",
+        "update|" + url % "2" + "|_ignored",
+        "update|" + url % "3" + "|_ignored",
+    ]
+    rabbit.get_message.side_effect = fake_queues(
+        {"odp_queue": queue_messages(mocker, bodies)}
+    )
+    publish_dataset = mocker.patch.object(cc, "publish_dataset")
+
+    cc.start_consuming_ex()
+
+    assert [c[0][0] for c in publish_dataset.call_args_list] == [
+        url % "0",
+        url % "1",
+    ]
+    channel = rabbit.get_channel.return_value
+    acked = [c[1]["delivery_tag"] for c in channel.basic_ack.call_args_list]
+    assert sorted(acked) == [1, 2, 3, 4, 5, 6]
+
+
+def test_ack_in_batches(mocker):
+    channel = mocker.Mock()
+    acks = ckanclient.AckBatcher(channel, 3)
+    for delivery_tag in range(1, 7):
+        acks.add(delivery_tag)
+    acks.ack(2)
+    acks.ack(1)
+    channel.basic_ack.assert_not_called()
+    acks.ack(4)
+    # 3 is not processed yet, 4 is acknowledged alone
+    assert channel.basic_ack.call_args_list == [
+        mocker.call(delivery_tag=2, multiple=True),
+        mocker.call(delivery_tag=4),
+    ]
+    channel.basic_ack.reset_mock()
+    acks.discard(3)
+    acks.ack(5)
+    acks.ack(6)
+    acks.flush()
+    channel.basic_ack.assert_called_once_with(delivery_tag=6, multiple=True)
+
+
+def test_ack_in_batches_after_a_failure(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.ack_batch = 3
+    rabbit = mocker.patch.object(cc, "rabbit")
+    channel = rabbit.get_channel.return_value
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    bodies = ["update|" + url % n + "|_ignored" for n in range(7)]
+    # the failed dataset comes back from the retry queue in the same run
+    bodies.append(bodies[1])
+    rabbit.get_message.side_effect = fake_queues(
+        {"odp_queue": queue_messages(mocker, bodies)}
+    )
+    publish_dataset = mocker.patch.object(cc, "publish_dataset")
+    publish_dataset.side_effect = lambda u: u == url % 1 and 1 / 0
+
+    cc.start_consuming_ex()
+
+    assert publish_dataset.call_count == 7
+    # the failed message does not hold back the batches after it
+    calls = channel.basic_ack.call_args_list
+    assert calls[-1] == mocker.call(delivery_tag=8, multiple=True)
+    assert len(calls) <= 4
+    # the second time it is not processed nor counted as a retry
+    assert retried(channel) == [
+        ("odp_queue_retry", bodies[1], 1),
+        ("odp_queue_retry", bodies[1], 0),
+    ]
+
+
+def test_empty_queue_loads_no_client(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    rabbit = mocker.patch.object(cc, "rabbit")
+    rabbit.get_message.return_value = (None, None, None)
+
+    cc.start_consuming_ex()
+
+    assert cc._odp is None and cc._sds is None and cc._renderer is None
+    rabbit.close_connection.assert_called_once_with()
@@ -0,0 +1,115 @@
+import remap
+
+
+def test_resolve_url_caches_every_hop(mocker, tmp_path):
+    query_replaces = mocker.patch("sdsclient.SDSClient.query_replaces")
+    query_replaces.return_value = {"results": {"bindings": []}}
+    rd = remap.RemapDatasets(tmp_path)
+    redirects = {"http://a": "http://b", "http://b": "http://c"}
+
+    def head(url, timeout):
+        resp = mocker.Mock(is_redirect=url in redirects, status_code=200)
+        resp.next.url = redirects.get(url)
+        return resp
+
+    rd.session = mocker.Mock()
+    rd.session.head.side_effect = head
+
+    assert rd.resolve_url("http://a") == "http://c"
+    assert rd.session.head.call_count == 3
+
+    rd = remap.RemapDatasets(tmp_path)
+    rd.session = mocker.Mock()
+    assert rd.resolve_url("http://b") == "http://c"
+    assert rd.resolve_url("http://a") == "http://c"
+    rd.session.head.assert_not_called()
+
+
+def test_resolve_url_does_not_cache_server_errors(mocker, tmp_path):
+    query_replaces = mocker.patch("sdsclient.SDSClient.query_replaces")
+    query_replaces.return_value = {"results": {"bindings": []}}
+    rd = remap.RemapDatasets(tmp_path)
+    rd.session = mocker.Mock()
+    resp = rd.session.head.return_value
+    resp.is_redirect = False
+    resp.status_code = 503
+    resp.raise_for_status.side_effect = ConnectionError("503")
+
+    assert rd.try_resolve_url("http://a") == "http://a"
+    assert rd.redirects.get("http://a") == (False, None)
+
+    # the next run asks again
+    resp.status_code = 301
+    resp.is_redirect = True
+    resp.next.url = "http://b"
+    final = mocker.Mock(is_redirect=False, status_code=200)
+    rd.session.head.side_effect = [resp, final]
+    assert rd.resolve_url("http://a") == "http://b"
+    assert rd.session.head.call_count == 3
+
+
+def test_mark_obsolete_resumes(mocker, tmp_path):
+    query_replaces = mocker.patch("sdsclient.SDSClient.query_replaces")
+    query_replaces.return_value = {"results": {"bindings": []}}
+    rd = remap.RemapDatasets(tmp_path)
+    uri = "http://data.europa.eu/88u/dataset/%s"
+    url = "http://www.eea.europa.eu/data-and-maps/data/dataset-%s"
+    rd.datasets_csv.write_text(
+        "ckan_uri,product_id,url\n"
+        + "".join("%s,DAT-1-en,%s\n" % (uri % n, url % n) for n in range(4)),
+        encoding="utf-8",
+    )
+    get_datasets = mocker.patch.object(rd.sds, "get_datasets")
+    get_datasets.side_effect = lambda urls, check_obsolete: {
+        u: {"url": u} for u in urls if not u.endswith("1")
+    }
+    publish_dataset = mocker.patch.object(rd, "publish_dataset")
+    publish_dataset.side_effect = lambda u, c, d, data: (
+        u.endswith("2") and 1 / 0
+    )
+
+    assert rd.mark_obsolete(workers=2) == 1
+    assert rd.journal.done("mark_obsolete") == {uri % n for n in [0, 1, 3]}
+    assert "ZeroDivisionError" in rd.journal.failed("mark_obsolete")[uri % 2]
+    # one query for the datasets, the one missing is queried when published
+    get_datasets.assert_called_once_with(
+        [url % n for n in range(4)], check_obsolete=False
+    )
+    publish_dataset.assert_any_call(url % 0, uri % 0, None, {"url": url % 0})
+    publish_dataset.assert_any_call(url % 1, uri % 1, None, None)
+
+    publish_dataset.reset_mock()
+    publish_dataset.side_effect = None
+    assert rd.mark_obsolete(workers=2) == 0
+    publish_dataset.assert_called_once_with(
+        url % 2, uri % 2, None, {"url": url % 2}
+    )
+    assert rd.journal.failed("mark_obsolete") == {}
+
+
+def test_download_only_saves_modified_packages(mocker, tmp_path):
+    query_replaces = mocker.patch("sdsclient.SDSClient.query_replaces")
+    query_replaces.return_value = {"results": {"bindings": []}}
+    rd = remap.RemapDatasets(tmp_path)
+    uri = "http://data.europa.eu/88u/dataset/%s"
+    packages = [
+        {"dataset": {"uri": uri % n}, "metadata_modified": "2020-01-01"}
+        for n in range(5)
+    ]
+    package_search = mocker.patch.object(rd.odp, "package_search")
+    package_search.return_value = packages
+    save = mocker.spy(rd.mirror, "save")
+
+    rd.download(batch_size=2)
+    assert [len(c[0][0]) for c in save.call_args_list] == [2, 2, 1]
+    assert list(rd.iter_datasets()) == packages
+
+    save.reset_mock()
+    packages[1]["metadata_modified"] = "2020-02-01"
+    del packages[3]
+    rd.download(batch_size=2)
+    assert [c[0][0] for c in save.call_args_list] == [
+        [("1", "2020-02-01", packages[1])]
+    ]
+    assert list(rd.iter_datasets()) == packages
+    assert rd.mirror.get("3") is None
@@ -1,6 +1,19 @@
+import json
+import os
+import socket
+import threading
+from datetime import datetime, timezone
+
+import pytest
+from rdflib import Graph
+
 import ckanclient
+import sdsclient
+from config import other_config
+from rdfindex import RDFIndex
+from store import CheckpointStore, ResponseCache
 
-from .conftest import mock_sds
+from .conftest import mock_sds, sds_responses
 
 
 def test_get_dataset_latest_version_is_newer(mocker):
@@ -37,3 +50,368 @@ def test_get_dataset_latest_version_is_same(mocker):
         "http://www.eea.europa.eu/data-and-maps/data/"
         "european-union-emissions-trading-scheme-13"
     )
+
+
+def test_query_sds_uses_pooled_session(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    post = mocker.patch.object(cc.sds.session, "post")
+    post.return_value.status_code = 200
+    post.return_value.text = "{}"
+
+    assert cc.sds.query_sds("SELECT 1", "application/json") == "{}"
+    assert cc.sds.query_sds("SELECT 2", "application/json") == "{}"
+
+    assert post.call_count == 2
+    assert post.call_args[1]["timeout"] == (
+        other_config["connect_timeout"],
+        cc.sds.timeout,
+    )
+    post.return_value.raise_for_status.assert_called_with()
+
+
+def test_get_datasets_in_batches(mocker):
+    urls = {
+        "DAT-21-en": (
+            "http://www.eea.europa.eu/data-and-maps/data/"
+            "european-union-emissions-trading-scheme-13"
+        ),
+        "DAT-137-en": (
+            "http://www.eea.europa.eu/data-and-maps/data/"
+            "eunis-habitat-classification"
+        ),
+        "DAT-150-en": (
+            "http://www.eea.europa.eu/data-and-maps/data/"
+            "air-pollutant-concentrations-at-station"
+        ),
+    }
+    cc = ckanclient.CKANClient("odp_queue")
+
+    expected = {}
+    g = Graph()
+    for product_id, url in urls.items():
+        rdf = (sds_responses / (product_id + ".rdf")).read_text("utf-8")
+        expected[url] = cc.sds.parse_dataset(rdf, url)
+        g.parse(data=rdf)
+
+    query_sds = mocker.patch.object(cc.sds, "query_sds")
+    query_sds.return_value = g.serialize(format="xml").decode("utf-8")
+    missing = "http://www.eea.europa.eu/data-and-maps/data/missing"
+
+    datasets = cc.sds.get_datasets(
+        list(urls.values()) + [missing], batch_size=2
+    )
+
+    assert query_sds.call_count == 2
+    first_query = query_sds.call_args_list[0][0][0]
+    assert "IN (<%s>, <%s>)" % tuple(urls.values())[:2] in first_query
+    assert datasets == expected
+
+
+def test_get_latest_version_from_index(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.sds.version_index_ttl = 3600
+    prefix = "http://www.eea.europa.eu/data-and-maps/data/"
+    query_sds = mocker.patch.object(cc.sds, "query_sds")
+    query_sds.return_value = json.dumps({"results": {"bindings": [
+        {
+            "dataset": {"type": "uri", "value": prefix + old},
+            "latest": {"type": "uri", "value": prefix + "dataset-3"},
+        }
+        for old in ["dataset-1", "dataset-2"]
+    ]}})
+
+    assert cc.sds.get_latest_version(prefix + "dataset-1") == (
+        prefix + "dataset-3"
+    )
+    assert cc.sds.get_latest_version(prefix + "dataset-2") == (
+        prefix + "dataset-3"
+    )
+    assert cc.sds.get_latest_version(prefix + "dataset-3") == (
+        prefix + "dataset-3"
+    )
+    assert query_sds.call_count == 1
+
+
+def test_refresh_version_index_in_background(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.sds.version_index_ttl = 3600
+    now = mocker.patch("time.time", return_value=1000.0)
+    query = mocker.patch.object(cc.sds, "query_latest_versions")
+    query.return_value = {"http://a": "http://b"}
+    assert cc.sds.get_version_index() == {"http://a": "http://b"}
+
+    # the stale index is served while the new one is queried
+    now.return_value += 3601
+    running = threading.Event()
+    query.side_effect = lambda: running.wait(5) and {"http://a": "http://c"}
+    assert cc.sds.get_version_index() == {"http://a": "http://b"}
+    assert cc.sds.get_version_index() == {"http://a": "http://b"}
+    running.set()
+    cc.sds.version_index_thread.join(5)
+    assert cc.sds.get_version_index() == {"http://a": "http://c"}
+    assert query.call_count == 2
+
+    # after a failure the index is kept, and no query is sent for a while
+    now.return_value += 3601
+    query.side_effect = ConnectionError
+    cc.sds.get_version_index(wait=True)
+    assert cc.sds.get_version_index() == {"http://a": "http://c"}
+    assert cc.sds.version_index_thread is None
+    assert query.call_count == 3
+    now.return_value += cc.sds.refresh_retry
+    query.side_effect = None
+    query.return_value = {}
+    assert cc.sds.get_version_index(wait=True) == {}
+
+
+@pytest.mark.parametrize(
+    "product_id, dataset_url",
+    [
+        ("DAT-21-en", "european-union-emissions-trading-scheme-13"),
+        ("DAT-137-en", "eunis-habitat-classification"),
+        ("DAT-150-en", "air-pollutant-concentrations-at-station"),
+        ("DAT-176-en", "fuel-quality-directive-1"),
+    ],
+)
+def test_parse_dataset_with_index_parser(product_id, dataset_url):
+    cc = ckanclient.CKANClient("odp_queue")
+    dataset_url = "http://www.eea.europa.eu/data-and-maps/data/" + dataset_url
+    rdf = (sds_responses / (product_id + ".rdf")).read_text("utf-8")
+
+    cc.sds.parser = "rdflib"
+    expected = cc.sds.parse_dataset(rdf, dataset_url)
+    cc.sds.parser = "index"
+    assert cc.sds.parse_dataset(rdf, dataset_url) == expected
+
+
+@pytest.mark.parametrize(
+    "rdf",
+    [
+        '<rdf:Description rdf:about="http://a" dct:title="T"/>',
+        '<rdf:Description rdf:about="http://a" xml:base="http://b/"/>',
+        '<rdf:Description rdf:about="http://a">'
+        '<dct:title rdf:ID="t">T</dct:title></rdf:Description>',
+    ],
+)
+def test_index_parser_rejects_unsupported_syntax(rdf):
+    rdf = (
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+        'xmlns:dct="http://purl.org/dc/terms/">%s</rdf:RDF>' % rdf
+    )
+    with pytest.raises(ValueError):
+        RDFIndex(rdf)
+
+
+def test_query_sds_cache(mocker, tmp_path):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.sds.cache = ResponseCache(tmp_path / "cache.db", 1024 * 1024)
+    post = mocker.patch.object(cc.sds.session, "post")
+    post.return_value.status_code = 200
+    post.return_value.text = '{"results": {"bindings": []}}'
+    post.return_value.headers = {"ETag": '"v1"'}
+
+    for _ in range(3):
+        text = cc.sds.query_sds("SELECT 1", "application/json")
+        assert text == '{"results": {"bindings": []}}'
+    assert post.call_count == 1
+
+    # stale entries are revalidated
+    cc.sds.cache_ttl = 0
+    post.return_value.status_code = 304
+    post.return_value.text = ""
+    text = cc.sds.query_sds("SELECT 1", "application/json")
+    assert text == '{"results": {"bindings": []}}'
+    assert post.call_count == 2
+    assert post.call_args[1]["headers"]["If-None-Match"] == '"v1"'
+
+
+def test_query_sds_revalidates_for_messages(mocker, tmp_path):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.sds.cache = ResponseCache(tmp_path / "cache.db", 1024 * 1024)
+    post = mocker.patch.object(cc.sds.session, "post")
+    post.return_value.status_code = 200
+    post.return_value.text = "v1"
+    post.return_value.headers = {}
+    assert cc.sds.query_sds("SELECT 1", "application/xml") == "v1"
+
+    # the dataset is edited, SDS sends no ETag/Last-Modified
+    post.return_value.text = "v2"
+    assert cc.sds.query_sds("SELECT 1", "application/xml") == "v1"
+    with cc.sds.revalidate():
+        assert cc.sds.query_sds("SELECT 1", "application/xml") == "v2"
+    assert post.call_count == 2
+    # the fresh response is cached for the other runs
+    assert cc.sds.query_sds("SELECT 1", "application/xml") == "v2"
+
+    def publish_dataset(dataset_url):
+        assert cc.sds.local.revalidate
+        return True
+
+    mocker.patch.object(cc, "publish_dataset", side_effect=publish_dataset)
+    assert cc.message_callback("update|http://example.com/dataset|_id")
+    assert not cc.sds.local.revalidate
+
+
+def test_response_cache_eviction(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.db", 2000)
+    for n in range(20):
+        cache.set("key-%s" % n, os.urandom(500).hex())
+    size = cache.execute("SELECT SUM(size) FROM response")[0][0]
+    assert size <= 2000
+    assert cache.get("key-19") is not None
+    assert cache.get("key-0") is None
+
+
+def test_session_does_not_retry_read_timeouts():
+    import requests
+
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+    connections = []
+
+    def accept():
+        # never answers
+        while True:
+            try:
+                connections.append(server.accept()[0])
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+    session = sdsclient.make_session(1, retries=3, backoff=0)
+    url = "http://127.0.0.1:%s/sparql" % server.getsockname()[1]
+    try:
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            session.post(url, data={"query": "ASK {}"}, timeout=0.2)
+    finally:
+        server.close()
+        for connection in connections:
+            connection.close()
+    assert len(connections) == 1
+
+
+def test_bulk_update_resumes_after_interruption(mocker, tmp_path):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.sds.checkpoints = CheckpointStore(tmp_path / "state.db")
+    mocker.patch.dict(other_config, {"page_size": 3})
+    prefix = "http://www.eea.europa.eu/data-and-maps/data/dataset-"
+    urls = [prefix + "%02d" % n for n in range(8)]
+
+    new_watermark = mocker.patch.object(cc.sds, "new_watermark")
+    new_watermark.return_value = "2020-05-15T07:51:12Z"
+
+    def query_sds(query, format):
+        after = query.split('STR(?dataset) > "')[1].split('"')[0]
+        page = [u for u in urls if u > after][:3]
+        bindings = [{"dataset": {"type": "uri", "value": u}} for u in page]
+        return json.dumps({"results": {"bindings": bindings}})
+
+    mocker.patch.object(cc.sds, "query_sds").side_effect = query_sds
+    rabbit = mocker.patch.object(cc.sds, "get_rabbit").return_value
+    channel = rabbit.get_channel.return_value
+    sent = []
+
+    def basic_publish(exchange, routing_key, body, properties):
+        if len(sent) == 4:
+            raise RuntimeError("connection lost")
+        sent.append(body.decode("utf-8").split("|")[1])
+        return True
+
+    channel.basic_publish.side_effect = basic_publish
+    with pytest.raises(RuntimeError):
+        cc.sds.bulk_update()
+    assert sent == urls[:4]
+    assert cc.sds.checkpoints.get("bulk_update") == urls[2]
+
+    new_watermark.return_value = "2020-05-16T00:00:00Z"
+    del sent[:]
+    channel.basic_publish.side_effect = None
+    channel.basic_publish.return_value = True
+    cc.sds.bulk_update()
+    published = [
+        c[1]["body"].decode("utf-8").split("|")[1]
+        for c in channel.basic_publish.call_args_list
+    ]
+    assert published[-5:] == urls[3:]
+    channel.tx_select.assert_called_with()
+    # one transaction per page: the first page, then the two pages of the
+    # resumed run
+    assert channel.tx_commit.call_count == 3
+    assert cc.sds.checkpoints.get("bulk_update") is None
+    # the watermark of the interrupted run, when it started
+    assert cc.sds.checkpoints.get("bulk_watermark") == "2020-05-15T07:51:12Z"
+
+    cc.sds.bulk_update(restart=True)
+    assert cc.sds.checkpoints.get("bulk_watermark") == "2020-05-16T00:00:00Z"
+
+
+def test_bulk_update_in_transactions(mocker):
+    cc = ckanclient.CKANClient("odp_queue")
+    mocker.patch.dict(other_config, {"page_size": 5})
+    cc.sds.publish_batch = 2
+    prefix = "http://www.eea.europa.eu/data-and-maps/data/dataset-"
+    urls = [prefix + "%02d" % n for n in range(7)]
+    mocker.patch.object(cc.sds, "iter_all_datasets").return_value = urls
+    rabbit = mocker.patch.object(cc.sds, "get_rabbit").return_value
+    channel = rabbit.get_channel.return_value
+    calls = []
+
+    def basic_publish(**kwargs):
+        calls.append("publish")
+        return True
+
+    channel.basic_publish.side_effect = basic_publish
+    channel.tx_commit.side_effect = lambda: calls.append("commit")
+
+    cc.sds.bulk_update()
+
+    channel.tx_select.assert_called_once_with()
+    # every 2 messages, at the end of the page of 5 and at the end
+    assert calls == (
+        ["publish", "publish", "commit"] * 2
+        + ["publish", "commit"] * 3
+    )
+
+
+def test_incremental_update(mocker, tmp_path):
+    cc = ckanclient.CKANClient("odp_queue")
+    cc.sds.checkpoints = CheckpointStore(tmp_path / "state.db")
+    cc.sds.checkpoints.set("bulk_watermark", "2020-05-15T07:51:12Z")
+    prefix = "http://www.eea.europa.eu/data-and-maps/data/dataset-"
+    query_sds = mocker.patch.object(cc.sds, "query_sds")
+    query_sds.return_value = json.dumps({"results": {"bindings": [
+        {
+            "dataset": {"type": "uri", "value": prefix + "1"},
+            "last_modified": {"value": "2020-06-01T10:00:00+02:00"},
+        },
+        {
+            "dataset": {"type": "uri", "value": prefix + "2"},
+            "last_modified": {"value": "2020-06-01T09:00:00Z"},
+        },
+    ]}})
+    rabbit = mocker.patch.object(cc.sds, "get_rabbit").return_value
+    channel = rabbit.get_channel.return_value
+    channel.basic_publish.return_value = True
+    now = datetime(2020, 6, 2, 12, 0, tzinfo=timezone.utc)
+    mocker.patch("sdsclient.datetime").now.return_value = now
+    cc.sds.watermark_overlap = 3600
+
+    cc.sds.incremental_update()
+
+    query = query_sds.call_args[0][0]
+    assert '> "2020-05-15T07:51:12Z"^^xsd:dateTime' in query
+    published = [
+        c[1]["body"].decode("utf-8")
+        for c in channel.basic_publish.call_args_list
+    ]
+    assert published == [
+        "update|%s1|_fake_dataset_identifier_" % prefix,
+        "update|%s2|_fake_dataset_identifier_" % prefix,
+    ]
+    assert {
+        c[1]["routing_key"] for c in channel.basic_publish.call_args_list
+    } == {"odp_queue_bulk"}
+    # when the update started, minus the overlap: the datasets harvested by
+    # SDS later, with an older dct:modified, are found by the next update
+    assert cc.sds.checkpoints.get("bulk_watermark") == "2020-06-02T11:00:00Z"
@@ -0,0 +1,49 @@
+import pytest
+
+from sparql import QueryTemplate, get_query
+
+
+def test_render_parameters():
+    query = QueryTemplate(
+        'PREFIX gis: <http://www.eea.europa.eu/GIS%%20Application#>\n'
+        'SELECT * WHERE {\n'
+        '  VALUES ?dataset { %(datasets)s }\n'
+        '  FILTER (?other IN (%(datasets)s))\n'
+        '  FILTER (?dataset != <%(dataset)s>)\n'
+        '  FILTER (STR(?title) > "%(after)s")\n'
+        '} LIMIT %(limit)s'
+    )
+    text = query.render(
+        datasets=["http://a/1", "http://a/2"],
+        dataset="http://a/x y>",
+        after='say "hi"\n',
+        limit=10,
+    )
+    assert text == (
+        'PREFIX gis: <http://www.eea.europa.eu/GIS%20Application#>\n'
+        'SELECT * WHERE {\n'
+        '  VALUES ?dataset { <http://a/1> <http://a/2> }\n'
+        '  FILTER (?other IN (<http://a/1>, <http://a/2>))\n'
+        '  FILTER (?dataset != <http://a/x%20y%3E>)\n'
+        '  FILTER (STR(?title) > "say \\"hi\\"\\n")\n'
+        '} LIMIT 10'
+    )
+
+
+def test_reject_invalid_parameters():
+    query = QueryTemplate("SELECT * { ?s ?p <%(o)s> } LIMIT %(limit)s")
+    with pytest.raises(ValueError):
+        query.render(o="not a url", limit=1)
+    with pytest.raises(ValueError):
+        query.render(o="http://a", limit="1; DROP")
+    with pytest.raises(KeyError):
+        query.render(o="http://a")
+    with pytest.raises(ValueError):
+        QueryTemplate("SELECT * { ?s ?p %(o)s }")
+
+
+def test_query_files():
+    assert get_query("query_datasets") is get_query("query_datasets")
+    text = get_query("query_datasets").render(datasets=["http://a/1"])
+    assert text.count("<http://a/1>") == 2
+    assert "GIS%20Application" in text
@@ -9,8 +9,15 @@ if [ -z "$CKAN_CLIENT_INTERVAL_BULK" ]; then
 fi
 
 > /etc/crontabs/root
-echo "$CKAN_CLIENT_INTERVAL python3 /app/ckanclient.py" >> /etc/crontabs/root
+# with CKAN_CLIENT_DAEMON set, the messages are consumed by a long running
+# "python3 /app/ckanclient.py --daemon" (e.g. in another container)
+if [ -z "$CKAN_CLIENT_DAEMON" ]; then
+  echo "$CKAN_CLIENT_INTERVAL python3 /app/ckanclient.py" >> /etc/crontabs/root
+fi
 echo "$CKAN_CLIENT_INTERVAL_BULK python3 /app/sdsclient.py" >> /etc/crontabs/root
+if [ -n "$CKAN_CLIENT_INTERVAL_INCREMENTAL" ]; then
+  echo "$CKAN_CLIENT_INTERVAL_INCREMENTAL python3 /app/sdsclient.py --incremental" >> /etc/crontabs/root
+fi
 echo "root" > /etc/crontabs/cron.update
 
 exec "$@"